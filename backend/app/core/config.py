@@ -9,11 +9,66 @@ class Settings(BaseSettings):
     GOOGLE_API_KEY: str
     LLAMA_CLOUD_API_KEY: str 
     QDRANT_URL: str = "http://localhost:6333"
+    QDRANT_GRPC_PORT: int = 6334
+    QDRANT_PREFER_GRPC: bool = True
+    COLLECTION_STATUS_TTL: int = 60 # Collection 存在/有資料檢查的快取秒數
+    # HNSW 索引參數 (建立 Collection / 搜尋時使用)
+    HNSW_M: int = 24
+    HNSW_EF_CONSTRUCT: int = 200
+    HNSW_EF_SEARCH: int = 128
+    QDRANT_QUANTIZATION: bool = True # 新建 Collection 時啟用 int8 純量量化
+    MMR_MIN_POINTS: int = 50 # Collection 少於此筆數時改用純相似度搜尋
+    MMR_CANDIDATES: int = 20 # Qdrant 端 MMR 的候選筆數 (在伺服器端計算，不傳輸候選向量)
+    MMR_DIVERSITY: float = 0.5 # 0 = 只看相關性，1 = 只看多樣性
+
+    # 伺服器設定 (python -m app.main)
+    HOST: str = "127.0.0.1"
+    PORT: int = 8000
+    # 快取失效狀態 (session epoch / collection 狀態 / 回答快取) 都存在 process 內，
+    # 多個 worker 之間不會同步，因此預設只開一個 worker
+    WORKERS: int = 1
+    DEV_RELOAD: bool = False # True: 單一 worker + reload
+    THREADPOOL_SIZE: int = 64 # anyio threadpool 大小 (同步端點 / 檔案 I/O)
     
     # 定義模型名稱
     LLM_MODEL: str = "gemini-3-flash-preview" 
     # Embedding 模型 
     EMBEDDING_MODEL: str = "models/gemini-embedding-001"
+    # Matryoshka 截斷後的向量維度 (gemini-embedding-001 原生 3072 維；設 0 表示不截斷)
+    EMBEDDING_DIMENSIONS: int = 768
+    # Embedding 快取 (SQLite 持久化 + 記憶體 LRU)
+    EMBEDDING_CACHE_PATH: str = "embedding_cache.sqlite3"
+    EMBEDDING_CACHE_SIZE: int = 4096
+    EMBEDDING_CACHE_MAX_ROWS: int = 200_000 # SQLite 最多保留的向量筆數
+    # 每次 Embedding API 請求的文字數 (Gemini 上限 100)
+    EMBEDDING_BATCH_SIZE: int = 100
+    # 文件向量化時同時送往 Embedding API 的批次數上限 (整個 process 共用，避免大量上傳觸發 429)
+    EMBEDDING_CONCURRENCY: int = 4
+    # 文件切分 (字元數)
+    CHUNK_SIZE: int = 800
+    CHUNK_OVERLAP: int = 120
+
+    # Reranker (選用，需安裝 sentence-transformers)
+    RERANKER_ENABLED: bool = False
+    RERANKER_MODEL: str = "BAAI/bge-reranker-v2-m3"
+    RERANKER_CANDIDATES: int = 30
+    RERANKER_DEVICE: str = "auto" # auto / cuda / cpu
+    RERANKER_BATCH_SIZE: int = 32
+
+    # LLM / RAG 回答快取
+    RESPONSE_CACHE_SIZE: int = 1024
+    RESPONSE_CACHE_TTL: int = 3600 # 秒
+    # 網路搜尋 (Web Search Fallback) 答案快取
+    WEB_CACHE_SIZE: int = 2048
+    WEB_CACHE_TTL: int = 6 * 3600 # 秒
+
+    # 自動填表時同時處理的欄位數上限 (避免觸發 API Rate Limit)
+    EXTRACTION_CONCURRENCY: int = 8
+    # 批次抽取時一次檢索的文件片段數
+    BATCH_EXTRACTION_TOP_K: int = 10
+
+    # 多檔上傳時同時送往 LlamaParse 解析的檔案數上限
+    INGEST_CONCURRENCY: int = 4
 
     class Config:
         env_file = ".env"
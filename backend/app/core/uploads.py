@@ -0,0 +1,18 @@
+import os
+import shutil
+import tempfile
+
+from fastapi import UploadFile
+
+def save_upload_to_temp(file: UploadFile) -> str:
+    """
+    將上傳檔案以 1MB 分塊串流寫入暫存檔，回傳暫存檔路徑
+    同步 I/O，在 async 流程中請以 anyio.to_thread.run_sync 呼叫
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
+        shutil.copyfileobj(file.file, tmp, length=1024 * 1024)
+        return tmp.name
+
+def remove_if_exists(path: str):
+    if os.path.exists(path):
+        os.remove(path)
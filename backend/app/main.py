@@ -1,18 +1,37 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Form
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Form, Depends
+from fastapi.responses import FileResponse, StreamingResponse
+from pydantic import BaseModel, TypeAdapter
 from typing import List
-import json
+from contextlib import asynccontextmanager
+import anyio
+import orjson
 
 from app.core.config import settings
 from app.services.llm_service import llm_service
-from app.services.rag_service import rag_service
+from app.services.rag_service import RAGService, get_rag_service
 from app.schemas.extraction import ExtractionRequest, ExtractionResponse, FieldResult
-from app.services.extraction_service import extraction_service
+from app.services.extraction_service import ExtractionService, get_extraction_service
 from app.services.schema_service import schema_service
 from app.services.file_filler_service import file_filler_service
 
-app = FastAPI(title=settings.PROJECT_NAME, version=settings.VERSION)
+# RAG / 抽取服務以 Depends 注入 (import app 時不會建立；async 版本不必切到 threadpool)
+async def rag_service_dep() -> RAGService:
+    return get_rag_service()
+
+async def extraction_service_dep() -> ExtractionService:
+    return get_extraction_service()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 放大 FastAPI (anyio) 的 threadpool，同步端點與 anyio.to_thread.run_sync 的工作才不會互相排隊
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.THREADPOOL_SIZE
+    # 啟動時先建立服務 (在 event loop 上建立 Async Qdrant Client)，第一個請求不必等初始化
+    get_extraction_service()
+    yield
+
+app = FastAPI(title=settings.PROJECT_NAME, version=settings.VERSION, lifespan=lifespan)
+
+_RESULTS_ADAPTER = TypeAdapter(List[FieldResult])
 
 # 定義 Request Schema
 class ChatRequest(BaseModel):
@@ -22,6 +41,9 @@ class QueryRequest(BaseModel):
     question: str
     session_id: str
 
+class EmbedRequest(BaseModel):
+    text: str
+
 @app.get("/")
 def health_check():
     return {"status": "ok", "service": "AutoFill AI"}
@@ -42,7 +64,8 @@ def test_llm(request: ChatRequest):
 async def upload_reference(
     files: List[UploadFile] = File(...), 
     session_id: str = Form(...),
-    background_tasks: BackgroundTasks = None
+    background_tasks: BackgroundTasks = None,
+    rag_service: RAGService = Depends(rag_service_dep),
 ):
     """
     上傳參考文件(PDF/Word)，支援多檔上傳。
@@ -53,16 +76,14 @@ async def upload_reference(
         if file.content_type not in ["application/pdf", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]:
             pass 
     try:
-        results = []
-        for file in files:
-            res = await rag_service.process_and_index_document(file, session_id)
-            results.append({"filename": file.filename, "status": "success", "chunks": res["chunks"]})
+        # 併行解析所有檔案 (有併發上限)，再把所有片段合併成批次一起向量化 + 寫入
+        results = await rag_service.process_and_index_documents(files, session_id)
         return {"uploaded_count": len(results), "details": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.post("/api/query")
-async def query_knowledge_base(request: QueryRequest):
+async def query_knowledge_base(request: QueryRequest, rag_service: RAGService = Depends(rag_service_dep)):
     """
     RAG 問答接口：根據已上傳的文件回答問題
     """
@@ -72,17 +93,55 @@ async def query_knowledge_base(request: QueryRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/api/embed")
+async def embed_text(request: EmbedRequest, rag_service: RAGService = Depends(rag_service_dep)):
+    """
+    回傳文字的向量 (與 RAG 檢索共用同一個 Embedding 模型與快取)，供前端語意快取比對問題
+    """
+    try:
+        return {"embedding": await rag_service.embeddings.aembed_query(request.text)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+@app.post("/api/query-stream")
+async def query_knowledge_base_stream(request: QueryRequest, rag_service: RAGService = Depends(rag_service_dep)):
+    """
+    RAG 問答接口 (串流版): 以 Server-Sent Events 逐段回傳 Agent 的回答
+    每個事件為 data: {"type": "sources" | "token" | "done" | "error", ...}
+    """
+    async def event_stream():
+        async for event in rag_service.stream_query_document(request.question, request.session_id):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    
 @app.post("/api/extract", response_model=ExtractionResponse)
-async def extract_form_data(request: ExtractionRequest):
+async def extract_form_data(request: ExtractionRequest, extraction_service: ExtractionService = Depends(extraction_service_dep)):
     """
     自動填表 API: 接收欄位定義，回傳填完值的 JSON
     """
     try:
-        results = await extraction_service.extract_fields(request.fields, request.session_id)
+        results = await extraction_service.extract_fields_batched(request.fields, request.session_id)
         return ExtractionResponse(results=results)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/api/extract-stream")
+async def extract_form_data_stream(request: ExtractionRequest, extraction_service: ExtractionService = Depends(extraction_service_dep)):
+    """
+    自動填表 (NDJSON 串流版): 每完成一個欄位就送出一行 JSON，不必等所有欄位完成
+    每行: {"type": "field", "result": {...}} ... {"type": "done"}
+    """
+    async def ndjson_stream():
+        try:
+            async for item in extraction_service.extract_fields_stream(request.fields, request.session_id):
+                yield orjson.dumps({"type": "field", "result": item.model_dump()}) + b"\n"
+            yield orjson.dumps({"type": "done"}) + b"\n"
+        except Exception as e:
+            yield orjson.dumps({"type": "error", "content": str(e)}) + b"\n"
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+    
 @app.post("/api/analyze-form")
 async def analyze_form_structure(file: UploadFile = File(...)):
     """
@@ -94,6 +153,17 @@ async def analyze_form_structure(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/api/analyze-forms")
+async def analyze_forms_structure(files: List[UploadFile] = File(...)):
+    """
+    一次上傳多份空白表格，只呼叫 LLM 一次，回傳每份表格的欄位定義
+    """
+    try:
+        forms = await schema_service.analyze_forms_batch(files)
+        return {"forms": [{"filename": f.filename, "fields": fields} for f, fields in zip(files, forms)]}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
 @app.post("/api/generate-file")
 async def generate_filled_file(
     file: UploadFile = File(...), 
@@ -103,11 +173,11 @@ async def generate_filled_file(
     接收原本的空白表格 + 提取出的結果 JSON -> 回傳填寫好的檔案
     """
     try:
-        # 解析 JSON 字串回 List[FieldResult]
-        results_data = json.loads(results_json)
-        results_objects = [FieldResult(**item) for item in results_data]
+        # 解析 JSON 字串回 List[FieldResult] (orjson 解析 + TypeAdapter 一次驗證整個列表)
+        results_objects = _RESULTS_ADAPTER.validate_python(orjson.loads(results_json))
         
-        output_path = file_filler_service.fill_document(file, results_objects)
+        # PDF/Word 填寫是 CPU 密集的同步運算，丟到 anyio threadpool (大小為 THREADPOOL_SIZE) 避免卡住 event loop
+        output_path = await anyio.to_thread.run_sync(file_filler_service.fill_document, file, results_objects)
         
         # 回傳檔案
         return FileResponse(
@@ -121,4 +191,17 @@ async def generate_filled_file(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app.main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    if settings.DEV_RELOAD:
+        # 開發模式: 單一 worker + 自動重載
+        uvicorn.run("app.main:app", host=settings.HOST, port=settings.PORT, reload=True)
+    else:
+        # 正式模式: worker 數由 WORKERS 決定 (預設 1，各 worker 的快取不共用)
+        # loop / http 設為 auto 時 uvicorn[standard] 會自動使用 uvloop + httptools
+        uvicorn.run(
+            "app.main:app",
+            host=settings.HOST,
+            port=settings.PORT,
+            workers=settings.WORKERS,
+            loop="auto",
+            http="auto",
+        )
\ No newline at end of file
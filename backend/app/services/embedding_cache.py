@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+class CachedEmbeddings(Embeddings):
+    """
+    包裝任意 LangChain Embeddings，以 sha256(model:task:text) 為 key 快取向量
+    (task 區分 query / doc: 上游以不同的 task type 產生向量，兩者不能共用)
+    1. 行程內 LRU (最近使用的向量)
+    2. SQLite 持久化 (重啟後仍有效，最多保留 max_rows 筆，超過時淘汰最早寫入的)
+    都 miss 時才呼叫上游 Embedding API，miss 的文字依 batch_size 分批送出
+    設定 dimensions 時，上游向量截斷為前 dimensions 維並重新做 L2 正規化 (Matryoshka 表示法)
+    """
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        model_name: str,
+        db_path: str,
+        maxsize: int = 4096,
+        batch_size: int = 100,
+        dimensions: Optional[int] = None,
+        max_concurrency: int = 4,
+        max_rows: int = 200_000,
+    ):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.maxsize = maxsize
+        self.max_rows = max_rows
+        # 每次呼叫上游最多送出的文字數 (Gemini Embedding 單次上限 100)
+        self.batch_size = batch_size
+        # aembed_documents 共用的上游併發上限 (多個上傳同時進行時也不會一次打出所有批次)
+        # 查詢向量不受限，避免排在大量上傳的批次後面
+        self._upstream_sem = asyncio.Semaphore(max_concurrency)
+        self.dimensions = dimensions or None
+        # 不同維度的向量不能混用，維度也是快取 key 的一部分
+        self._key_prefix = f"{model_name}@{self.dimensions}" if self.dimensions else model_name
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock() # 保護記憶體 LRU
+        self._db_lock = threading.Lock() # 保護 SQLite 連線 (與記憶體分開，查記憶體不必等 SQLite)
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # 多個 uvicorn worker 共用同一個 SQLite 檔: WAL 讓讀寫不互相阻塞，寫入衝突時等待而非直接報錯
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache (hash TEXT PRIMARY KEY, model TEXT, vector BLOB)"
+        )
+        self._conn.commit()
+
+    def _hash(self, text: str, task: str) -> str:
+        return hashlib.sha256(f"{self._key_prefix}:{task}:{text}".encode()).hexdigest()
+
+    def _truncate(self, vector: List[float]) -> List[float]:
+        """截斷到前 dimensions 維後重新正規化 (截斷後的向量長度不再為 1，Cosine 以外的距離會失真)"""
+        if not self.dimensions or len(vector) <= self.dimensions:
+            return vector
+        head = vector[:self.dimensions]
+        norm = math.sqrt(sum(x * x for x in head)) or 1.0
+        return [x / norm for x in head]
+
+    def _get_memory(self, h: str) -> Optional[List[float]]:
+        with self._lock:
+            if h in self._memory:
+                self._memory.move_to_end(h)
+                return self._memory[h]
+        return None
+
+    def _get(self, h: str) -> Optional[List[float]]:
+        # 先查記憶體 LRU
+        vector = self._get_memory(h)
+        if vector is not None:
+            return vector
+        # 再查 SQLite
+        with self._db_lock:
+            row = self._conn.execute("SELECT vector FROM embedding_cache WHERE hash = ?", (h,)).fetchone()
+        if row is None:
+            return None
+        vector = array("f", row[0]).tolist()
+        self._remember(h, vector)
+        return vector
+
+    def _remember(self, h: str, vector: List[float]):
+        with self._lock:
+            self._memory[h] = vector
+            self._memory.move_to_end(h)
+            if len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def _put_many(self, items: Dict[str, List[float]]):
+        for h, vector in items.items():
+            self._remember(h, vector)
+        with self._db_lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (hash, model, vector) VALUES (?, ?, ?)",
+                [(h, self.model_name, array("f", vector).tobytes()) for h, vector in items.items()],
+            )
+            # INSERT OR REPLACE 每次都配新的 rowid，rowid 越小代表越早寫入: 超過上限時刪掉最舊的部分
+            self._conn.execute(
+                "DELETE FROM embedding_cache WHERE rowid <= (SELECT MAX(rowid) FROM embedding_cache) - ?",
+                (self.max_rows,),
+            )
+            self._conn.commit()
+
+    def _lookup(self, texts: List[str]):
+        """回傳 (hashes, 已命中的向量, 需要呼叫上游的文字)"""
+        hashes = [self._hash(t, "doc") for t in texts]
+        found = {}
+        misses = {}
+        for h, text in zip(hashes, texts):
+            if h in found or h in misses:
+                continue
+            vector = self._get(h)
+            if vector is None:
+                misses[h] = text
+            else:
+                found[h] = vector
+        return hashes, found, misses
+
+    def _batches(self, misses: Dict[str, str]) -> List[List[str]]:
+        texts = list(misses.values())
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, found, misses = self._lookup(texts)
+        if misses:
+            vectors = [
+                self._truncate(v) for batch in self._batches(misses) for v in self.underlying.embed_documents(batch)
+            ]
+            fresh = dict(zip(misses.keys(), vectors))
+            self._put_many(fresh)
+            found.update(fresh)
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        h = self._hash(text, "query")
+        vector = self._get(h)
+        if vector is None:
+            vector = self._truncate(self.underlying.embed_query(text))
+            self._put_many({h: vector})
+        return vector
+
+    # async 版本: SQLite 存取 (其他 worker 寫入時可能等待最多 timeout 秒) 丟到 thread 執行，不卡住 event loop
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes, found, misses = await asyncio.to_thread(self._lookup, texts)
+        if misses:
+            async def _embed(batch: List[str]) -> List[List[float]]:
+                async with self._upstream_sem:
+                    return await self.underlying.aembed_documents(batch)
+
+            results = await asyncio.gather(*[_embed(batch) for batch in self._batches(misses)])
+            vectors = [self._truncate(v) for batch_vectors in results for v in batch_vectors]
+            fresh = dict(zip(misses.keys(), vectors))
+            await asyncio.to_thread(self._put_many, fresh)
+            found.update(fresh)
+        return [found[h] for h in hashes]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        h = self._hash(text, "query")
+        # 記憶體命中時直接回傳，不必切換 thread
+        vector = self._get_memory(h)
+        if vector is None:
+            vector = await asyncio.to_thread(self._get, h)
+        if vector is None:
+            vector = self._truncate(await self.underlying.aembed_query(text))
+            await asyncio.to_thread(self._put_many, {h: vector})
+        return vector
@@ -1,116 +1,332 @@
+import asyncio
+import functools
 import logging
-from typing import List
-from langchain_community.tools import DuckDuckGoSearchRun
+import re
+from collections import defaultdict
+from typing import AsyncIterator, List
+from cachetools import TTLCache
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 
+from app.core.config import settings
 from app.schemas.extraction import ExtractionField, FieldResult
-from app.services.rag_service import rag_service
+from app.services.rag_service import format_docs, get_rag_service
 
 logger = logging.getLogger(__name__)
 
+# 數字欄位後處理用 (預先編譯，避免每個欄位重新解析 pattern)
+_NUM_RE = re.compile(r"-?\d*\.?\d+")
+_STRIP_COMMAS = str.maketrans("", "", ",")
+
+# Prompt 只在 import 時建立一次，不在每次抽取時重新解析
+# 多欄位批次抽取: 一次 LLM 呼叫回傳 {key: value}
+_BATCH_PROMPT = ChatPromptTemplate.from_template("""
+Extract the values for the following form fields using ONLY the context below.
+
+=== CONTEXT ===
+{context}
+===============
+
+Fields (key: description (format rule)):
+{fields}
+
+Respond ONLY with a JSON object {{key: value}}. Use "MISSING" for unknowns.
+""")
+
+# 網路搜尋結果整理
+_WEB_SUMMARY_PROMPT = ChatPromptTemplate.from_template("""
+請根據以下的網路搜尋結果，回答問題：{question}
+
+【搜尋結果】：
+{context}
+
+請直接給出答案值，不要有多餘的廢話。若還是找不到，請回答 "N/A"。
+""")
+
 class ExtractionService:
     def __init__(self):
+        rag_service = get_rag_service()
         self.llm = rag_service.llm
         self.embeddings = rag_service.embeddings
-        self.search_tool = DuckDuckGoSearchRun() 
+        # 與 RAG Agent 共用同一個搜尋工具實例
+        self.search_tool = rag_service.search_tool
+        # 網路搜尋結果快取: field.description -> 答案
+        self._web_cache = TTLCache(maxsize=settings.WEB_CACHE_SIZE, ttl=settings.WEB_CACHE_TTL)
+
+        self.batch_chain = _BATCH_PROMPT | self.llm | JsonOutputParser()
+        self.web_summary_chain = _WEB_SUMMARY_PROMPT | self.llm | StrOutputParser()
         
     async def extract_fields(self, fields: List[ExtractionField], session_id: str) -> List[FieldResult]:
+        """
+        並行處理所有欄位，以 Semaphore 限制同時對 Gemini / Qdrant 發出的請求數
+        """
+        sem = asyncio.Semaphore(settings.EXTRACTION_CONCURRENCY)
+
+        async def _bounded(field: ExtractionField) -> FieldResult:
+            async with sem:
+                return await self._extract_one(field, session_id)
+
+        # gather 依提交順序回傳，結果順序與 fields 一致
+        outcomes = await asyncio.gather(*[_bounded(f) for f in fields], return_exceptions=True)
+
         results = []
-        
+        for field, outcome in zip(fields, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"Extraction failed for {field.key}: {outcome}")
+                results.append(FieldResult(key=field.key, value="N/A", source="None", confidence="None"))
+            else:
+                results.append(outcome)
+        return results
+
+    async def extract_fields_batched(self, fields: List[ExtractionField], session_id: str) -> List[FieldResult]:
+        """
+        將所有欄位合併成一次檢索，再依答案長度分組，每組一次 LLM 呼叫 (回傳 {key: value} 的 JSON)
+        只有回答 MISSING 的欄位才退回逐欄處理 (extract_fields)
+        """
+        if not fields:
+            return []
+
+        # 1. 以所有欄位描述合併成一個查詢，只做一次 Embedding + Qdrant 檢索
+        batch_context = await self._retrieve_batch_context(fields, session_id)
+
+        # 沒有任何內部文件時，批次 Prompt 沒有意義，直接走逐欄流程 (RAG Agent + Web)
+        if batch_context is None:
+            return await self.extract_fields(fields, session_id)
+        context, sources = batch_context
+
+        # 2. 依預估答案長度分組 (boolean / number,date / string)，每組一個多欄位 Prompt
+        #    讓短答案不必等長答案，各組依長度由短到長送出並併行執行
+        ordered_bins = self._bin_fields(fields)
+
+        # 3. 每組一次 LLM 呼叫 + 4. 解析 JSON
+        outcomes = await asyncio.gather(
+            *[self._extract_bin(bin_fields, context) for bin_fields in ordered_bins],
+            return_exceptions=True,
+        )
+        results = {}
+        missing = []
+        for bin_fields, outcome in zip(ordered_bins, outcomes):
+            if isinstance(outcome, Exception):
+                # 該組失敗: 組內欄位視為 MISSING，交給下方逐欄處理
+                logger.warning(f"Batched extraction failed for {len(bin_fields)} field(s): {outcome}")
+                outcome = {}
+            hits, bin_missing = self._split_answers(bin_fields, outcome, sources)
+            results.update((item.key, item) for item in hits)
+            missing.extend(bin_missing)
+
+        # 只針對 MISSING 的欄位退回逐欄處理
+        if missing:
+            logger.info(f"Batched extraction missing {len(missing)} field(s), falling back per-field")
+            for item in await self.extract_fields(missing, session_id):
+                results[item.key] = item
+
+        return [results[f.key] for f in fields]
+
+    async def extract_fields_stream(self, fields: List[ExtractionField], session_id: str) -> AsyncIterator[FieldResult]:
+        """
+        與 extract_fields_batched 相同的流程，但每個欄位一完成就立即 yield (依完成順序，不是欄位順序)
+        批次組內 MISSING 的欄位會立刻排入逐欄處理，不必等其他組完成
+        """
+        if not fields:
+            return
+
+        sem = asyncio.Semaphore(settings.EXTRACTION_CONCURRENCY)
+
+        async def _one(field: ExtractionField):
+            async with sem:
+                try:
+                    return [await self._extract_one(field, session_id)], []
+                except Exception as e:
+                    logger.error(f"Extraction failed for {field.key}: {e}")
+                    return [FieldResult(key=field.key, value="N/A", source="None", confidence="None")], []
+
+        async def _bin(bin_fields: List[ExtractionField], context: str, sources: list):
+            try:
+                answers = await self._extract_bin(bin_fields, context)
+            except Exception as e:
+                logger.warning(f"Batched extraction failed for {len(bin_fields)} field(s): {e}")
+                answers = {}
+            return self._split_answers(bin_fields, answers, sources)
+
+        batch_context = await self._retrieve_batch_context(fields, session_id)
+        if batch_context is None:
+            pending = {asyncio.ensure_future(_one(f)) for f in fields}
+        else:
+            context, sources = batch_context
+            pending = {asyncio.ensure_future(_bin(b, context, sources)) for b in self._bin_fields(fields)}
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results, missing = task.result()
+                    for item in results:
+                        yield item
+                    pending |= {asyncio.ensure_future(_one(f)) for f in missing}
+        finally:
+            # 用戶端中斷連線時，取消還在執行的欄位
+            for task in pending:
+                task.cancel()
+
+    async def _retrieve_batch_context(self, fields: List[ExtractionField], session_id: str):
+        """所有欄位描述合併成一次檢索，回傳 (context, sources)；沒有任何內部文件時回傳 None"""
+        combined_query = " ".join(f.description for f in fields)
+        try:
+            docs = await get_rag_service().retrieve_documents(
+                combined_query, session_id, k=settings.BATCH_EXTRACTION_TOP_K
+            )
+        except Exception as e:
+            logger.warning(f"Batched retrieval failed, falling back to per-field extraction: {e}")
+            docs = []
+        if not docs:
+            return None
+        # 去重但保留順序 (同一份檔案的多個片段只列一次)
+        sources = list(dict.fromkeys(d.metadata.get("source", "unknown") for d in docs))
+        return format_docs(docs), sources
+
+    def _bin_fields(self, fields: List[ExtractionField]) -> List[List[ExtractionField]]:
+        """依預估答案長度分組，由短到長排列"""
+        bins = defaultdict(list)
+        for f in fields:
+            bins[self._predict_len(f)].append(f)
+        return [bins[length] for length in sorted(bins)]
+
+    def _split_answers(self, fields: List[ExtractionField], answers: dict, sources: list):
+        """批次 LLM 的 {key: value} -> (已找到答案的 FieldResult 列表, 回答 MISSING 的欄位列表)"""
+        hits = []
+        missing = []
         for field in fields:
-            logger.info(f"Extracting: {field.key}")
+            value = answers.get(field.key)
+            if value is None or "MISSING" in str(value):
+                missing.append(field)
+                continue
+            hits.append(FieldResult(
+                key=field.key,
+                value=self._post_process(str(value), field.data_type),
+                source=str(sources),
+                confidence="High (Doc)",
+            ))
+        return hits, missing
+
+    async def _extract_bin(self, fields: List[ExtractionField], context: str) -> dict:
+        field_lines = "\n".join(
+            f'- "{f.key}": {f.description} ({self._type_instruction(f.data_type)})' for f in fields
+        )
+        answers = await self.batch_chain.ainvoke({"context": context, "fields": field_lines})
+        if not isinstance(answers, dict):
+            raise ValueError(f"Expected a JSON object, got {type(answers).__name__}")
+        return answers
+
+    @staticmethod
+    def _predict_len(field: ExtractionField) -> int:
+        """預估答案長度 (token 數量級)，用來把長度相近的欄位分在同一批"""
+        if field.data_type == "boolean":
+            return 4
+        elif field.data_type in ("number", "date"):
+            return 10
+        else:
+            return 60
+
+    @staticmethod
+    def _type_instruction(data_type: str) -> str:
+        if data_type == "number":
+            return "Output ONLY the number. No currency symbols ($, ¥), no commas, no text units. Example: 500000 not $500k."
+        elif data_type == "date":
+            return "Output ONLY the date in YYYY-MM-DD format."
+        elif data_type == "boolean":
+            return "Output ONLY 'True' or 'False'."
+        else:
+            return "Output ONLY the exact value string. Do not use full sentences."
+
+    @staticmethod
+    def _post_process(answer: str, data_type: str) -> str:
+        if data_type == "number":
+            # 移除可能的非數字字符 (保留小數點和負號)
+            # 簡單過濾，若 AI 還是回話，這裡會盡量救回來
+            numeric_match = _NUM_RE.search(answer.translate(_STRIP_COMMAS))
+            if numeric_match:
+                answer = numeric_match.group()
+        return answer
+
+    async def _extract_one(self, field: ExtractionField, session_id: str) -> FieldResult:
+        logger.info(f"Extracting: {field.key}")
+        
+        # 根據資料類型給予不同指令
+        type_instruction = self._type_instruction(field.data_type)
+
+        # 組合 Prompt
+        query_prompt = f"""
+        Task: Extract the value for the field described as: "{field.description}"
+        
+        Rules:
+        1. {type_instruction}
+        2. Do NOT explain your answer.
+        3. Do NOT mention "According to the document".
+        4. If the information is not found, output exactly "MISSING".
+        """
+
+        # === 階段 1: 內部文件 RAG ===
+        try:
+            rag_answer_pack = await get_rag_service().query_document(
+                question=f"{field.description} (If you don't know the specific value, please answer MISSING)",
+                session_id=session_id
+            )
             
-            # 根據資料類型給予不同指令
-            type_instruction = ""
-            if field.data_type == "number":
-                type_instruction = "Output ONLY the number. No currency symbols ($, ¥), no commas, no text units. Example: 500000 not $500k."
-            elif field.data_type == "date":
-                type_instruction = "Output ONLY the date in YYYY-MM-DD format."
-            elif field.data_type == "boolean":
-                type_instruction = "Output ONLY 'True' or 'False'."
-            else:
-                type_instruction = "Output ONLY the exact value string. Do not use full sentences."
+            answer = rag_answer_pack["answer"]
+            sources = rag_answer_pack["source_documents"] # RAG 端已去重
+            
+            # 簡單的後處理 (Post-processing)
+            answer = self._post_process(answer, field.data_type)
 
-            # 組合 Prompt
-            query_prompt = f"""
-            Task: Extract the value for the field described as: "{field.description}"
+            # 判斷是否需要聯網
+            # 如果回答包含 "MISSING" 或 "未提及" 或來源是空的
+            # 關鍵修改：判斷是否需要聯網
+            # 條件 1: 答案包含 "MISSING" (LLM 承認不知道)
+            # 條件 2: 答案包含 "未提及"
+            # 條件 3: 完全沒有來源文件 (表示是純 LLM 瞎猜，對於精確填表來說不可靠，除非是常識題)
+            # 但如果是「填表」，通常我們不希望它用通用知識瞎掰數據，所以 "not sources" 應該觸發聯網
             
-            Rules:
-            1. {type_instruction}
-            2. Do NOT explain your answer.
-            3. Do NOT mention "According to the document".
-            4. If the information is not found, output exactly "MISSING".
-            """
-
-            # === 階段 1: 內部文件 RAG ===
-            try:
-                rag_answer_pack = await rag_service.query_document(
-                    question=f"{field.description} (If you don't know the specific value, please answer MISSING)",
-                    session_id=session_id
+            needs_web_search = "MISSING" in answer or "未提及" in answer or not sources
+            
+            # 特例：如果欄位是 Date/Boolean 這種通用問題，純 LLM 可能答對，但在填表場景下
+            # 我們假設使用者通常是問「這家公司的營收」，所以沒文件通常就該去搜尋。
+            
+            if not needs_web_search:
+                return FieldResult(
+                    key=field.key, value=answer, source=str(sources), confidence="High (Doc)"
                 )
-                
-                answer = rag_answer_pack["answer"]
-                sources = rag_answer_pack["source_documents"]
-                
-                # 簡單的後處理 (Post-processing)
-                if field.data_type == "number":
-                    # 移除可能的非數字字符 (保留小數點和負號)
-                    import re
-                    # 簡單過濾，若 AI 還是回話，這裡會盡量救回來
-                    numeric_match = re.search(r'-?\d*\.?\d+', answer.replace(',', ''))
-                    if numeric_match:
-                        answer = numeric_match.group()
-
-                # 判斷是否需要聯網
-                # 如果回答包含 "MISSING" 或 "未提及" 或來源是空的
-                # 關鍵修改：判斷是否需要聯網
-                # 條件 1: 答案包含 "MISSING" (LLM 承認不知道)
-                # 條件 2: 答案包含 "未提及"
-                # 條件 3: 完全沒有來源文件 (表示是純 LLM 瞎猜，對於精確填表來說不可靠，除非是常識題)
-                # 但如果是「填表」，通常我們不希望它用通用知識瞎掰數據，所以 "not sources" 應該觸發聯網
-                
-                needs_web_search = "MISSING" in answer or "未提及" in answer or not sources
-                
-                # 特例：如果欄位是 Date/Boolean 這種通用問題，純 LLM 可能答對，但在填表場景下
-                # 我們假設使用者通常是問「這家公司的營收」，所以沒文件通常就該去搜尋。
-                
-                if not needs_web_search:
-                    results.append(FieldResult(
-                        key=field.key, value=answer, source=str(sources), confidence="High (Doc)"
-                    ))
-                    continue 
 
-            except Exception as e:
-                logger.warning(f"RAG/LLM failed for {field.key}, trying web search...")
+        except Exception as e:
+            logger.warning(f"RAG/LLM failed for {field.key}, trying web search...")
 
-            # === 階段 2: 網路搜尋 (Web Search Fallback) ===
-            try:
-                logger.info(f"Searching web for: {field.description}")
-                # 搜尋網路
-                search_results = self.search_tool.invoke(field.description)
-                
-                # 讓 LLM 根據搜尋結果整理答案
-                summary_prompt = ChatPromptTemplate.from_template("""
-                請根據以下的網路搜尋結果，回答問題：{question}
-                
-                【搜尋結果】：
-                {context}
-                
-                請直接給出答案值，不要有多餘的廢話。若還是找不到，請回答 "N/A"。
-                """)
-                
-                chain = summary_prompt | self.llm | StrOutputParser()
-                web_answer = await chain.ainvoke({"question": field.description, "context": search_results})
-                
-                results.append(FieldResult(
-                    key=field.key, value=web_answer, source="Internet Search", confidence="Medium (Web)"
-                ))
+        # === 階段 2: 網路搜尋 (Web Search Fallback) ===
+        # 相同問題在 TTL 內已搜尋過，直接沿用答案
+        cached_answer = self._web_cache.get(field.description)
+        if cached_answer is not None:
+            return FieldResult(
+                key=field.key, value=cached_answer, source="Internet Search", confidence="Medium (Web, cached)"
+            )
 
-            except Exception as e:
-                logger.error(f"Web search failed for {field.key}: {e}")
-                results.append(FieldResult(key=field.key, value="N/A", source="None", confidence="None"))
-        
-        return results
+        try:
+            logger.info(f"Searching web for: {field.description}")
+            # 搜尋網路 (DuckDuckGo 是同步 HTTP，丟到 executor 避免卡住 event loop)
+            search_results = await asyncio.get_running_loop().run_in_executor(
+                None, self.search_tool.invoke, field.description
+            )
+            
+            # 讓 LLM 根據搜尋結果整理答案
+            web_answer = await self.web_summary_chain.ainvoke({"question": field.description, "context": search_results})
+            self._web_cache[field.description] = web_answer
+            
+            return FieldResult(
+                key=field.key, value=web_answer, source="Internet Search", confidence="Medium (Web)"
+            )
+
+        except Exception as e:
+            logger.error(f"Web search failed for {field.key}: {e}")
+            return FieldResult(key=field.key, value="N/A", source="None", confidence="None")
 
-extraction_service = ExtractionService()
\ No newline at end of file
+@functools.lru_cache(maxsize=1)
+def get_extraction_service() -> ExtractionService:
+    """延遲建立 ExtractionService singleton (import 模組時不會連帶建立 RAGService)"""
+    return ExtractionService()
@@ -1,10 +1,9 @@
-import os
-import shutil
-import tempfile
+import re
 from typing import List, Dict, Any
 from fastapi import UploadFile
-from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfString
+from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfObject, PdfString
 from docx import Document
+from app.core.uploads import save_upload_to_temp, remove_if_exists
 from app.schemas.extraction import FieldResult
 import logging
 
@@ -21,10 +20,8 @@ class FileFillerService:
         
         filename = file.filename.lower()
         
-        # 建立暫存檔來操作
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tmp:
-            shutil.copyfileobj(file.file, tmp)
-            input_path = tmp.name
+        # 建立暫存檔來操作 (1MB 分塊串流寫入，不整檔讀進記憶體)
+        input_path = save_upload_to_temp(file)
         
         output_path = input_path.replace(".", "_filled.")
 
@@ -39,8 +36,7 @@ class FileFillerService:
             return output_path
         finally:
             # 清理 input，保留 output 讓 controller 回傳
-            if os.path.exists(input_path):
-                os.remove(input_path)
+            remove_if_exists(input_path)
 
     def _fill_pdf(self, input_path: str, output_path: str, data: Dict[str, str]):
         """
@@ -48,20 +44,21 @@ class FileFillerService:
         注意: PDF 欄位名稱必須與 Extraction Field Key 一致
         """
         template_pdf = PdfReader(input_path)
-        
-        if template_pdf.Root.AcroForm:
-            for field in template_pdf.Root.AcroForm.Fields:
-                # 取得 PDF 內部的欄位名稱
-                field_name = field.T
-                if field_name:
-                    # 處理編碼 (有些 PDF 欄位是括號包起來的)
-                    key = field_name.replace("(", "").replace(")", "")
-                    
-                    if key in data:
-                        # 填入數值
-                        field.V = PdfString.encode(data[key])
-                        # field.Ff = PdfObject(1) 
-        
+
+        acro_form = template_pdf.Root.AcroForm
+        if acro_form:
+            # 建立 {欄位名稱: 欄位物件} 對照表 (有些 PDF 欄位名稱是括號包起來的)
+            field_map = {str(f.T).strip("()"): f for f in acro_form.Fields if f.T}
+
+            # 只對實際存在的欄位編碼並填入數值
+            for key, value in data.items():
+                field = field_map.get(key)
+                if field is not None:
+                    field.V = PdfString.encode(value)
+
+            # 請閱讀器依新的值重新產生外觀 (只需設定一次)
+            acro_form.update(PdfDict(NeedAppearances=PdfObject("true")))
+
         PdfWriter().write(output_path, template_pdf)
         logger.info(f"PDF filled: {output_path}")
 
@@ -69,26 +66,45 @@ class FileFillerService:
         """
         針對 Word 進行簡單的「關鍵字替換」
         它會尋找文件中的 {{key}} 並替換成 value
+        以單一 regex 一次替換所有 key，並在 run 層級修改以保留原本的文字格式
         """
         doc = Document(input_path)
-        
-        # 1. 替換段落中的文字
-        for paragraph in doc.paragraphs:
-            for key, value in data.items():
-                placeholder = f"{{{{{key}}}}}" # 尋找 {{key}}
-                if placeholder in paragraph.text:
-                    paragraph.text = paragraph.text.replace(placeholder, value)
-        
-        # 2. 替換表格中的文字
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for key, value in data.items():
-                        placeholder = f"{{{{{key}}}}}"
-                        if placeholder in cell.text:
-                            cell.text = cell.text.replace(placeholder, value)
-                            
+
+        if data:
+            # 一次比對所有 {{key}}
+            pattern = re.compile(r"\{\{(" + "|".join(re.escape(k) for k in data) + r")\}\}")
+
+            # 1. 替換段落中的文字
+            for paragraph in doc.paragraphs:
+                self._replace_in_paragraph(paragraph, pattern, data)
+
+            # 2. 替換表格中的文字
+            for table in doc.tables:
+                for row in table.rows:
+                    for cell in row.cells:
+                        for paragraph in cell.paragraphs:
+                            self._replace_in_paragraph(paragraph, pattern, data)
+
         doc.save(output_path)
         logger.info(f"Word filled: {output_path}")
 
+    @staticmethod
+    def _replace_in_paragraph(paragraph, pattern: "re.Pattern", data: Dict[str, str]):
+        # 快速過濾: 沒有 {{ 的段落直接略過
+        text = paragraph.text
+        if "{{" not in text:
+            return
+
+        def _sub(m):
+            return data[m.group(1)]
+
+        # 逐 run 替換，保留粗體 / 字型等格式
+        for run in paragraph.runs:
+            if "{{" in run.text:
+                run.text = pattern.sub(_sub, run.text)
+
+        # Word 有時會把 {{key}} 拆在多個 run 裡，這種情況退回整段替換
+        if pattern.search(paragraph.text):
+            paragraph.text = pattern.sub(_sub, paragraph.text)
+
 file_filler_service = FileFillerService()
\ No newline at end of file
@@ -1,3 +1,6 @@
+import hashlib
+import threading
+from cachetools import TTLCache
 from langchain_google_genai import ChatGoogleGenerativeAI
 from app.core.config import settings
 import logging
@@ -14,6 +17,10 @@ class LLMService:
                 temperature=0.3, 
                 convert_system_message_to_human=True
             )
+            # 回應快取 (cachetools 非 thread-safe，以 lock 保護)
+            self._cache = TTLCache(maxsize=settings.RESPONSE_CACHE_SIZE, ttl=settings.RESPONSE_CACHE_TTL)
+            self._cache_lock = threading.Lock()
+            self._key_locks = {}
             logger.info("LLM Service initialized successfully.")
         except Exception as e:
             logger.error(f"Failed to initialize LLM: {e}")
@@ -22,12 +29,31 @@ class LLMService:
     def generate_response(self, prompt: str) -> str:
         """
         發送 Prompt 給 LLM 並取得純文字回應
+        相同 Prompt 在 TTL 內直接回傳快取結果
         """
-        try:
-            response = self.llm.invoke(prompt)
-            return response.content
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            return "Sorry, I am having trouble thinking right now."
+        key = hashlib.blake2b(prompt.encode(), digest_size=16).digest()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Single-flight: 同一個 Prompt 只讓一個執行緒真的呼叫 LLM
+        with key_lock:
+            with self._cache_lock:
+                cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            try:
+                response = self.llm.invoke(prompt)
+                with self._cache_lock:
+                    self._cache[key] = response.content
+                return response.content
+            except Exception as e:
+                logger.error(f"Error generating response: {e}")
+                return "Sorry, I am having trouble thinking right now."
+            finally:
+                with self._cache_lock:
+                    self._key_locks.pop(key, None)
 
 llm_service = LLMService()
\ No newline at end of file
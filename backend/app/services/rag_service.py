@@ -1,35 +1,91 @@
-import os
-import shutil
-import tempfile
+import asyncio
+import functools
+import hashlib
 import logging
-from typing import List, Dict, Any
+import uuid
+from typing import List, Dict, Any, AsyncIterator, Optional
 
+from cachetools import TTLCache
 from fastapi import UploadFile
 from llama_cloud_services import LlamaParse
 
 # LangChain Core
 from langchain_core.documents import Document
 from langchain.agents import create_agent 
-from langchain_core.messages import SystemMessage
+from langchain_core.messages import AIMessageChunk, SystemMessage
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 # LangChain Google & Qdrant
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
+import grpc
+from qdrant_client import AsyncQdrantClient, models
+from qdrant_client.http.exceptions import UnexpectedResponse
 
 # Tools
 from langchain_community.tools import DuckDuckGoSearchRun
 
 from app.core.config import settings
+from app.services.embedding_cache import CachedEmbeddings
+from app.services.reranker_service import reranker_service
 
 logger = logging.getLogger(__name__)
 
+# Agent 的固定 System Prompt (檢索到的 INTERNAL CONTEXT 會在每次查詢時另外帶入)
+AGENT_SYSTEM_PROMPT = """
+You are a smart 'AutoFill Agent'.
+
+The INTERNAL CONTEXT retrieved from the user's uploaded files is provided in the next system message.
+
+CRITICAL INSTRUCTIONS:
+1. First, check the INTERNAL CONTEXT. If the answer is there, use it.
+2. If the answer is NOT in the context (e.g., comparing with a competitor not in the file), you MUST use the search tool.
+3. Do not just say "I don't know". Research it.
+4. When answering, cite your sources (e.g., "According to the file..." or "Based on web search...").
+"""
+
+# 每次查詢帶入的 INTERNAL CONTEXT 格式
+CONTEXT_TEMPLATE = (
+    "=== INTERNAL CONTEXT (From uploaded files) ===\n"
+    "{context}\n"
+    "=============================================="
+)
+
+def _part_to_text(part) -> str:
+    """content 列表中的單一元素 -> 文字 (字串原樣、{"text": ...} 取 text，其餘略過)"""
+    if type(part) is str:
+        return part
+    if isinstance(part, dict):
+        return part.get("text", "")
+    return ""
+
+def _is_not_found(error: Exception) -> bool:
+    """Qdrant 回報 Collection 不存在 (REST 404 / gRPC NOT_FOUND)"""
+    if isinstance(error, UnexpectedResponse):
+        return error.status_code == 404
+    if isinstance(error, grpc.RpcError):
+        return error.code() == grpc.StatusCode.NOT_FOUND
+    return False
+
+def format_docs(docs: List[Document]) -> str:
+    """將檢索到的文件片段合併成單一 Context 字串"""
+    return "\n\n".join(d.page_content for d in docs)
+
 class RAGService:
     def __init__(self):
-        # 初始化 Embeddings
-        self.embeddings = GoogleGenerativeAIEmbeddings(
-            model=settings.EMBEDDING_MODEL,
-            google_api_key=settings.GOOGLE_API_KEY
+        # 初始化 Embeddings (外層包一層快取，相同文字不重複呼叫 Embedding API)
+        self.embeddings = CachedEmbeddings(
+            GoogleGenerativeAIEmbeddings(
+                model=settings.EMBEDDING_MODEL,
+                google_api_key=settings.GOOGLE_API_KEY,
+                request_options={"timeout": 60} # 大批次請求需要較長的逾時
+            ),
+            model_name=settings.EMBEDDING_MODEL,
+            db_path=settings.EMBEDDING_CACHE_PATH,
+            maxsize=settings.EMBEDDING_CACHE_SIZE,
+            batch_size=settings.EMBEDDING_BATCH_SIZE,
+            dimensions=settings.EMBEDDING_DIMENSIONS,
+            max_concurrency=settings.EMBEDDING_CONCURRENCY,
+            max_rows=settings.EMBEDDING_CACHE_MAX_ROWS,
         )
 
         # 初始化 LLM
@@ -39,54 +95,317 @@ class RAGService:
             temperature=0.3
         )
         
+        # LlamaParse 解析器 (所有上傳共用同一個實例，不每個檔案重新建立)
+        # 參考: https://developers.llamaindex.ai/python/cloud/llamaparse/
+        self.parser = LlamaParse(
+            api_key=settings.LLAMA_CLOUD_API_KEY, 
+            result_type="markdown", 
+            verbose=True
+        )
+
+        # 文件切分 (先依段落、再依句子切)
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=settings.CHUNK_SIZE,
+            chunk_overlap=settings.CHUNK_OVERLAP,
+            separators=["\n\n", "\n", ". ", " "],
+        )
+
+        # 共用的 Async Qdrant Client (所有請求重複使用同一個連線池，不阻塞 event loop)
+        # 優先使用 gRPC (單一 HTTP/2 長連線，免去 JSON 序列化)
+        self.aqdrant = AsyncQdrantClient(
+            url=settings.QDRANT_URL,
+            prefer_grpc=settings.QDRANT_PREFER_GRPC,
+            grpc_port=settings.QDRANT_GRPC_PORT,
+            timeout=30,
+        )
+        # 存在/有資料的檢查結果短暫快取
+        self._search_params = models.SearchParams(
+            hnsw_ef=settings.HNSW_EF_SEARCH,
+            quantization=models.QuantizationSearchParams(ignore=False, rescore=True, oversampling=2.0),
+        )
+        self._collection_status = TTLCache(maxsize=1024, ttl=settings.COLLECTION_STATUS_TTL)
+        # 已確認存在的 Collection (確認過一次就不必再問 Qdrant)
+        # Collection 在 Qdrant 端消失時 (重啟遺失資料 / 手動刪除)，操作回報 not found 會把名稱移出 (見 _forget_collection)
+        self._known_collections: set = set()
+
         # 初始化 Tools
         self.search_tool = DuckDuckGoSearchRun()
         self.tools = [self.search_tool]
 
+        # 建立 Agent (只建立一次；每次查詢的 Context 以 SystemMessage 放進 messages)
+        self.agent = create_agent(
+            model=self.llm,
+            tools=self.tools,
+            system_prompt=AGENT_SYSTEM_PROMPT
+        )
+
+        # 問答結果快取: key = (collection_name, epoch, sha1(question))
+        # 文件重新索引時只要把該 Session 的 epoch +1，舊答案就不會再被命中 (由 TTL 自然淘汰)
+        self._answer_cache = TTLCache(maxsize=settings.RESPONSE_CACHE_SIZE, ttl=settings.RESPONSE_CACHE_TTL)
+        self._answer_locks: Dict[tuple, asyncio.Lock] = {}
+        self._session_epochs: Dict[str, int] = {}
+
         logger.info("LangChain Agent (LangGraph-based) Service initialized.")
 
-    async def process_and_index_document(self, file: UploadFile, session_id: str):
+    async def process_and_index_documents(self, files: List[UploadFile], session_id: str) -> List[Dict[str, Any]]:
+        """
+        多檔上傳: 以 Semaphore 限制同時解析的檔案數 (避免觸發 LlamaParse Rate Limit)，
+        所有檔案併行解析後，片段合併成批次一起向量化 + 寫入，回傳每個檔案的處理結果
+        """
+        sem = asyncio.Semaphore(settings.INGEST_CONCURRENCY)
+
+        async def _parse(file: UploadFile) -> List[Document]:
+            async with sem:
+                return await self.parse_document(file)
+
+        parsed = await asyncio.gather(*[_parse(file) for file in files])
+        all_chunks = [doc for docs in parsed for doc in docs]
+        await self.embed_and_index_batch(all_chunks, session_id, batch_size=settings.EMBEDDING_BATCH_SIZE)
+        return [
+            {"filename": file.filename, "status": "success", "chunks": len(docs)}
+            for file, docs in zip(files, parsed)
+        ]
+
+    async def parse_document(self, file: UploadFile) -> List[Document]:
+        """
+        上傳 -> LlamaParse 解析 -> 切分，回傳 LangChain Document 列表 (尚未向量化)
+        """
+        try:
+            # LlamaParse 可直接接受 bytes (需附上檔名判斷格式)，省去寫入 / 讀回暫存檔
+            file_bytes = await file.read()
+
+            # 使用 LlamaParse 解析
+            job_result = await self.parser.aparse(file_bytes, extra_info={"file_name": file.filename})
+            # 將 LlamaIndex 的文件格式轉換為 LangChain 的格式 (保留頁碼方便引用)
+            pages = [
+                Document(page_content=page.text, metadata={"source": file.filename, "page": page_number})
+                for page_number, page in enumerate(job_result.pages, start=1)
+            ]
+            # 整頁太長會稀釋語意，切成較小的片段再向量化 (metadata 會複製到每個片段)
+            return self.text_splitter.split_documents(pages)
+        except Exception as e:
+            logger.error(f"Parse Error: {e}")
+            raise e
+
+    async def embed_and_index_batch(self, docs: List[Document], session_id: str, batch_size: int = settings.EMBEDDING_BATCH_SIZE):
         """
-        上傳 -> 暫存 -> LlamaParse 解析 -> 切分 -> 向量化 -> 存入 Qdrant
-        處理文件並存入該 Session 專屬的 Collection
+        以批次呼叫 Embedding API (每批最多 batch_size 筆)，再每批一次 upsert 到 Qdrant
+        各批次的「向量化 -> 寫入」以 asyncio.gather 併行，向量化與寫入互相重疊
         """
         # 動態生成 Collection Name
         collection_name = f"session_{session_id}"
-        temp_file_path = None
+        if not docs:
+            return {"status": "success", "chunks": 0, "collection": collection_name}
+
         try:
-            # 將上傳的檔案存入暫存區
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-                shutil.copyfileobj(file.file, tmp)
-                temp_file_path = tmp.name
+            batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
 
-            # 使用 LlamaParse 解析
-            # 參考: https://developers.llamaindex.ai/python/cloud/llamaparse/
-            parser = LlamaParse(
-                api_key=settings.LLAMA_CLOUD_API_KEY, 
-                result_type="markdown", 
-                verbose=True
-            )
-            job_result = await parser.aparse(temp_file_path)
-            # 將 LlamaIndex 的文件格式轉換為 LangChain 的格式
-            langchain_docs = [Document(page_content=page.text, metadata={"source": file.filename}) for page in job_result.pages]
-
-            # 向量儲存到 Qdrant
-            # 參考: https://docs.langchain.com/oss/python/integrations/vectorstores/qdrant
-            QdrantVectorStore.from_documents(
-                documents=langchain_docs,
-                embedding=self.embeddings,
-                url=settings.QDRANT_URL,
-                collection_name=collection_name,
-                force_recreate=False # 不刪除舊資料
+            async def _embed(batch: List[Document]) -> List[List[float]]:
+                return await self.embeddings.aembed_documents([d.page_content for d in batch])
+
+            async def _index(batch: List[Document], vectors: List[List[float]] = None):
+                if vectors is None:
+                    vectors = await _embed(batch)
+                # 向量儲存到 Qdrant，payload 格式沿用 LangChain QdrantVectorStore (page_content / metadata)
+                points = [
+                    models.PointStruct(
+                        id=uuid.uuid4().hex,
+                        vector=vector,
+                        payload={"page_content": doc.page_content, "metadata": doc.metadata},
+                    )
+                    for doc, vector in zip(batch, vectors)
+                ]
+                try:
+                    await self.aqdrant.upsert(collection_name=collection_name, points=points)
+                except Exception as e:
+                    if not _is_not_found(e):
+                        raise
+                    # Collection 已在 Qdrant 端消失: 重新確認 / 建立後再寫入一次
+                    self._forget_collection(collection_name)
+                    await self._ensure_collection(collection_name, len(vectors[0]))
+                    await self.aqdrant.upsert(collection_name=collection_name, points=points)
+
+            # 第一批先向量化以得知維度，確保 Collection 存在後其餘批次全部併行
+            first_vectors = await _embed(batches[0])
+            await self._ensure_collection(collection_name, len(first_vectors[0]))
+            await asyncio.gather(
+                _index(batches[0], first_vectors),
+                *[_index(batch) for batch in batches[1:]],
             )
-            return {"status": "success", "chunks": len(langchain_docs), "collection": collection_name}
+
+            # 文件有更新，清掉該 Session 的狀態快取與舊答案
+            self._collection_status.pop(collection_name, None)
+            self._session_epochs[collection_name] = self._session_epochs.get(collection_name, 0) + 1
+            return {"status": "success", "chunks": len(docs), "collection": collection_name}
         except Exception as e:
             logger.error(f"Index Error: {e}")
             raise e
-        finally:
-            # 清理暫存檔案
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+
+    async def _get_collection_info(self, collection_name: str):
+        """取得 Collection 設定，不存在時回傳 None"""
+        try:
+            return await self.aqdrant.get_collection(collection_name)
+        except Exception as e:
+            if not _is_not_found(e):
+                raise
+            return None
+
+    @staticmethod
+    def _vector_size(info) -> Optional[int]:
+        vectors = info.config.params.vectors
+        return vectors.size if isinstance(vectors, models.VectorParams) else None
+
+    async def _ensure_collection(self, collection_name: str, vector_size: int):
+        """
+        Collection 不存在才建立 (不刪除舊資料)
+        維度與目前的 Embedding 不同時 (例如改用 768 維前建立的 3072 維 Collection)，舊向量已無法查詢，直接重建
+        """
+        if collection_name in self._known_collections:
+            return
+        info = await self._get_collection_info(collection_name)
+        if info is not None:
+            existing_size = self._vector_size(info)
+            if existing_size == vector_size:
+                self._known_collections.add(collection_name)
+                return
+            logger.warning(
+                f"Collection {collection_name} has {existing_size}-dim vectors, expected {vector_size}; recreating it"
+            )
+            await self.aqdrant.delete_collection(collection_name)
+        try:
+            await self._create_collection(collection_name, vector_size)
+        except Exception:
+            # 同一個 Session 的多個上傳請求可能同時建立 Collection，已被別人建立就沿用
+            if not await self.aqdrant.collection_exists(collection_name):
+                raise
+        self._known_collections.add(collection_name)
+
+    def _forget_collection(self, collection_name: str):
+        """Collection 不存在時清掉本地的存在 / 筆數快取，下次操作重新向 Qdrant 確認"""
+        self._known_collections.discard(collection_name)
+        self._collection_status.pop(collection_name, None)
+
+    async def _create_collection(self, collection_name: str, vector_size: int):
+        await self.aqdrant.create_collection(
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(
+                size=vector_size,
+                distance=models.Distance.COSINE,
+                on_disk=False,
+                # 以 FP16 儲存向量: 記憶體與頻寬減半，召回率幾乎不變
+                datatype=models.Datatype.FLOAT16,
+            ),
+            hnsw_config=models.HnswConfigDiff(m=settings.HNSW_M, ef_construct=settings.HNSW_EF_CONSTRUCT),
+            # int8 純量量化: 記憶體再省 4 倍，搜尋時以原始向量 rescore 維持召回率
+            quantization_config=models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(
+                    type=models.ScalarType.INT8,
+                    quantile=0.99,
+                    always_ram=True,
+                )
+            ) if settings.QDRANT_QUANTIZATION else None,
+        )
+        # 為來源檔名建立 keyword 索引，依檔案過濾時不必掃描所有 payload
+        await self.aqdrant.create_payload_index(
+            collection_name=collection_name,
+            field_name="metadata.source",
+            field_schema=models.PayloadSchemaType.KEYWORD,
+        )
+
+    async def _collection_size(self, collection_name: str) -> int:
+        """Collection 的 (近似) 資料筆數，不存在時為 0 (結果短暫快取，避免每次查詢都打 Qdrant)"""
+        size = self._collection_status.get(collection_name)
+        if size is None:
+            # 尚未確認存在時才查 Collection 設定；count 用近似值即可
+            if collection_name not in self._known_collections:
+                info = await self._get_collection_info(collection_name)
+                expected = settings.EMBEDDING_DIMENSIONS
+                if info is None or (expected and self._vector_size(info) != expected):
+                    # 不存在，或是維度不同的舊 Collection (查詢必定失敗，需重新上傳): 視為沒有資料
+                    self._collection_status[collection_name] = 0
+                    return 0
+                self._known_collections.add(collection_name)
+            try:
+                size = (await self.aqdrant.count(collection_name, exact=False)).count
+            except Exception as e:
+                if not _is_not_found(e):
+                    raise
+                # 記得的 Collection 已被刪除: 視為沒有資料，下次上傳時會重新建立
+                self._forget_collection(collection_name)
+                size = 0
+            self._collection_status[collection_name] = size
+        return size
+
+    @staticmethod
+    def _to_document(point: models.ScoredPoint) -> Document:
+        """Qdrant point -> LangChain Document (payload 格式與寫入時相同)"""
+        payload = point.payload or {}
+        return Document(page_content=payload.get("page_content", ""), metadata=payload.get("metadata") or {})
+
+    async def _search(self, collection_name: str, query_vector: List[float], k: int) -> List[Document]:
+        """純相似度搜尋，只取回 payload (不傳輸向量)"""
+        response = await self.aqdrant.query_points(
+            collection_name=collection_name,
+            query=query_vector,
+            limit=k,
+            search_params=self._search_params,
+            with_payload=True,
+        )
+        return [self._to_document(p) for p in response.points]
+
+    async def _mmr_search(self, collection_name: str, query_vector: List[float], k: int) -> List[Document]:
+        """
+        由 Qdrant 伺服器端執行 MMR (兼顧相關性與多樣性)，只回傳最終 k 筆的 payload
+        候選向量不必傳回 Python 端，也省去 Python 端的 MMR 計算
+        """
+        response = await self.aqdrant.query_points(
+            collection_name=collection_name,
+            query=models.NearestQuery(
+                nearest=query_vector,
+                mmr=models.Mmr(diversity=settings.MMR_DIVERSITY, candidates_limit=settings.MMR_CANDIDATES),
+            ),
+            limit=k,
+            search_params=self._search_params,
+            with_payload=True,
+        )
+        return [self._to_document(p) for p in response.points]
+
+    async def retrieve_documents(self, question: str, session_id: str, k: int = 3) -> List[Document]:
+        """
+        從該 Session 的 Collection 撈出與問題相關的文件片段
+        Collection 不存在或沒有資料時回傳空列表
+        """
+        collection_name = f"session_{session_id}"
+
+        # 已知沒有資料時不必向量化問題
+        if self._collection_status.get(collection_name) == 0:
+            return []
+
+        # Qdrant 狀態查詢 (已快取時立即返回) 與問題向量化同時進行
+        collection_size, query_vector = await asyncio.gather(
+            self._collection_size(collection_name),
+            self.embeddings.aembed_query(question),
+        )
+        if collection_size == 0:
+            return []
+
+        try:
+            if reranker_service.enabled:
+                # 先多撈候選片段 (純相似度)，再交給 Cross-Encoder 精排，只把前 k 筆送進 LLM
+                candidates = await self._search(collection_name, query_vector, max(k, settings.RERANKER_CANDIDATES))
+                return await reranker_service.rerank(question, candidates, top_k=k)
+
+            if collection_size < settings.MMR_MIN_POINTS:
+                # 資料量很少時 MMR 的多樣性幫助不大，直接取最相似的 k 筆 (少抓向量、省去 MMR 計算)
+                return await self._search(collection_name, query_vector, k)
+
+            return await self._mmr_search(collection_name, query_vector, k)
+        except Exception as e:
+            if not _is_not_found(e):
+                raise
+            # 筆數快取還沒過期但 Collection 已消失: 當作沒有文件
+            self._forget_collection(collection_name)
+            return []
 
     async def query_document(self, question: str, session_id: str):
         """
@@ -98,98 +417,147 @@ class RAGService:
            - 足夠 -> 直接回答
            - 不足 -> 呼叫 Search Tool -> 整合後回答
         """
-        collection_name = f"session_{session_id}"
-        
+        # 相同 (Collection, 問題) 在 TTL 內直接回傳快取答案
+        key = self._answer_key(question, session_id)
+        cached = self._answer_cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Single-flight: 同一個 key 只讓一個請求真的去跑 Agent，其餘等待後讀快取
+        lock = self._answer_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            cached = self._answer_cache.get(key)
+            if cached is not None:
+                return cached
+
+            try:
+                result = await self._run_agent(question, session_id)
+            except Exception as e:
+                logger.error(f"Agent Error: {e}")
+                # 錯誤結果不寫入快取
+                return {
+                    "answer": f"Processing Error: {str(e)}",
+                    "source_documents": []
+                }
+            finally:
+                self._answer_locks.pop(key, None)
+
+            self._answer_cache[key] = result
+            return result
+
+    async def stream_query_document(self, question: str, session_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        與 query_document 相同的 Agentic RAG，但以 self.agent.astream 逐段產生回答
+        依序 yield:
+          {"type": "sources", "source_documents": [...]}  (檢索完成後立即送出)
+          {"type": "token", "content": "..."}              (LLM 每產生一段文字)
+          {"type": "reset"}                                (Agent 改為呼叫工具，先前送出的文字作廢)
+          {"type": "done", "source_documents": [...]}      (結束，含是否用到網路搜尋)
+        """
+        key = self._answer_key(question, session_id)
+        cached = self._answer_cache.get(key)
+        if cached is not None:
+            yield {"type": "sources", "source_documents": cached["source_documents"]}
+            yield {"type": "token", "content": cached["answer"]}
+            yield {"type": "done", "source_documents": cached["source_documents"]}
+            return
+
         try:
-            client = QdrantClient(url=settings.QDRANT_URL)
-            
-            # 檢索階段 (Retrieval)
-            # 參考: https://reference.langchain.com/python/integrations/langchain_qdrant/#langchain_qdrant.QdrantVectorStore
-            retrieved_context = "No internal documents found."
-            sources = []
-
-            # 檢查 Collection 是否存在且有資料
-            collections = client.get_collections().collections
-            if any(c.name == collection_name for c in collections) and client.count(collection_name).count > 0:
-                vector_store = QdrantVectorStore(
-                    client=client,
-                    collection_name=collection_name,
-                    embedding=self.embeddings,
-                )
-                retriever = vector_store.as_retriever(search_type="mmr", search_kwargs={"k": 3, "fetch_k": 5})
-                docs = await retriever.ainvoke(question)
-                
-                if docs:
-                    retrieved_context = "\n\n".join([d.page_content for d in docs])
-                    sources = [d.metadata.get("source", "unknown") for d in docs]
-
-            # 定義 System Prompt
-            system_prompt_content = f"""
-            You are a smart 'AutoFill Agent'.
-            
-            === INTERNAL CONTEXT (From uploaded files) ===
-            {retrieved_context}
-            ==============================================
-            
-            CRITICAL INSTRUCTIONS:
-            1. First, check the INTERNAL CONTEXT. If the answer is there, use it.
-            2. If the answer is NOT in the context (e.g., comparing with a competitor not in the file), you MUST use the search tool.
-            3. Do not just say "I don't know". Research it.
-            4. When answering, cite your sources (e.g., "According to the file..." or "Based on web search...").
-            """
-
-            # 建立 Agent
-            agent = create_agent(
-                model=self.llm,          
-                tools=self.tools,         
-                system_prompt=system_prompt_content 
-            )
+            messages, sources = await self._prepare_messages(question, session_id)
+            yield {"type": "sources", "source_documents": list(sources)}
 
-            # 執行 Agent
-            result = await agent.ainvoke(
-                {"messages": [{"role": "user", "content": question}]}
-            )
-            
-            # 解析結果
-            last_message = result["messages"][-1]
-            raw_content = last_message.content
-            final_answer = ""
-            
-            # 純字串
-            if isinstance(raw_content, str):
-                final_answer = raw_content  
-            # 列表 
-            elif isinstance(raw_content, list):
-                for item in raw_content:
-                    if isinstance(item, str):
-                        final_answer += item
-                    elif isinstance(item, dict) and "text" in item:
-                        final_answer += item["text"]
-            # 其他
-            else:
-                final_answer = str(raw_content)
-            
-            logger.info(f"Agent Final Answer: {final_answer[:100]}...")
-
-            # 處理 Sources 標記 (檢查是否使用了工具)
-            for msg in result["messages"]:
-                # 檢查是否有 ToolMessage (代表工具被呼叫並回傳了結果)
-                if msg.type == "tool": 
-                     if "Internet Search" not in sources:
-                        sources.append("Internet Search")
-
-            logger.info(f"Agent Answer: {final_answer[:100]}...")
-
-            return {
-                "answer": final_answer,
-                "source_documents": sources
-            }
+            answer_parts = []
+            used_search = False
+            async for chunk, _ in self.agent.astream(
+                {"messages": messages},
+                stream_mode="messages",
+            ):
+                if chunk.type == "tool" or (isinstance(chunk, AIMessageChunk) and chunk.tool_call_chunks):
+                    # 呼叫工具前的文字不是最終回答: 清掉，只保留最後一輪 (與 _run_agent 快取的內容一致)
+                    if answer_parts:
+                        answer_parts.clear()
+                        yield {"type": "reset"}
+                    if not used_search and self._is_search_result(chunk):
+                        # 搜尋工具被呼叫並回傳了結果 (只需標記一次)
+                        used_search = True
+                elif isinstance(chunk, AIMessageChunk):
+                    text = self._content_to_text(chunk.content)
+                    if text:
+                        answer_parts.append(text)
+                        yield {"type": "token", "content": text}
 
+            if used_search:
+                sources.append("Internet Search")
+            self._answer_cache[key] = {"answer": "".join(answer_parts), "source_documents": sources}
+            yield {"type": "done", "source_documents": sources}
         except Exception as e:
-            logger.error(f"Agent Error: {e}")
-            return {
-                "answer": f"Processing Error: {str(e)}",
-                "source_documents": []
-            }
+            logger.error(f"Agent Stream Error: {e}")
+            yield {"type": "error", "content": f"Processing Error: {str(e)}"}
+
+    def _answer_key(self, question: str, session_id: str) -> tuple:
+        """問答快取的 key: 問題以 sha1 摘要表示 (key 長度固定)，並帶上該 Session 目前的 epoch"""
+        collection_name = f"session_{session_id}"
+        return (
+            collection_name,
+            self._session_epochs.get(collection_name, 0),
+            hashlib.sha1(question.encode()).digest(),
+        )
+
+    async def _prepare_messages(self, question: str, session_id: str):
+        """檢索相關文件，組成送給 Agent 的 messages (Context 以 SystemMessage 帶入)，回傳 (messages, sources)"""
+        # 檢索階段 (Retrieval)
+        retrieved_context = "No internal documents found."
+        sources = []
+
+        docs = await self.retrieve_documents(question, session_id)
+        if docs:
+            retrieved_context = format_docs(docs)
+            # 去重但保留順序 (同一份檔案的多個片段只列一次)
+            sources = list(dict.fromkeys(d.metadata.get("source", "unknown") for d in docs))
+
+        messages = [
+            SystemMessage(content=CONTEXT_TEMPLATE.format(context=retrieved_context)),
+            {"role": "user", "content": question},
+        ]
+        return messages, sources
+
+    def _is_search_result(self, msg) -> bool:
+        """是否為網路搜尋工具回傳的 ToolMessage"""
+        return msg.type == "tool" and msg.name == self.search_tool.name
+
+    @staticmethod
+    def _content_to_text(raw_content) -> str:
+        """將 LLM 回傳的 content (字串 / 列表 / 其他) 轉成純文字"""
+        # 純字串
+        if isinstance(raw_content, str):
+            return raw_content
+        # 列表 (一次 join，不逐段串接字串)
+        if isinstance(raw_content, list):
+            return "".join(map(_part_to_text, raw_content))
+        # 其他
+        return str(raw_content)
+
+    async def _run_agent(self, question: str, session_id: str):
+        messages, sources = await self._prepare_messages(question, session_id)
+
+        # 執行 Agent
+        result = await self.agent.ainvoke({"messages": messages})
+        
+        # 解析結果
+        final_answer = self._content_to_text(result["messages"][-1].content)
+        
+        logger.info(f"Agent Final Answer: {final_answer[:100]}...")
+
+        # 處理 Sources 標記 (檢查搜尋工具是否被呼叫，找到第一個就停止)
+        if any(self._is_search_result(msg) for msg in result["messages"]):
+            sources.append("Internet Search")
+
+        return {
+            "answer": final_answer,
+            "source_documents": sources
+        }
 
-rag_service = RAGService()
\ No newline at end of file
+@functools.lru_cache(maxsize=1)
+def get_rag_service() -> RAGService:
+    """延遲建立 RAGService singleton (只 import 模組時不會初始化 LLM / Qdrant 連線)"""
+    return RAGService()
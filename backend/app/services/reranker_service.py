@@ -0,0 +1,47 @@
+import asyncio
+import logging
+from typing import List
+
+from langchain_core.documents import Document
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+class RerankerService:
+    def __init__(self):
+        self.enabled = settings.RERANKER_ENABLED
+        self.model = None
+
+        if self.enabled:
+            # 只有啟用時才載入 (sentence-transformers 為選用套件，模型權重也很大)
+            import torch
+            from sentence_transformers import CrossEncoder
+
+            device = settings.RERANKER_DEVICE
+            if device == "auto":
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+
+            # 模型只在啟動時載入一次 (module-level singleton)，之後所有請求共用
+            self.model = CrossEncoder(settings.RERANKER_MODEL, device=device, max_length=512)
+            if device.startswith("cuda"):
+                # GPU 上以 FP16 推論，延遲與顯存都減半
+                self.model.model.half()
+            logger.info(f"Reranker loaded: {settings.RERANKER_MODEL} on {device}")
+
+    async def rerank(self, question: str, docs: List[Document], top_k: int) -> List[Document]:
+        """
+        以 Cross-Encoder 對 (問題, 文件片段) 重新評分，只保留分數最高的 top_k 筆
+        """
+        if not self.enabled or len(docs) <= 1:
+            return docs[:top_k]
+
+        pairs = [(question, d.page_content) for d in docs]
+        # 所有 pair 一次批次送進模型；predict 是 CPU/GPU 密集運算，丟到 thread 避免卡住 event loop
+        scores = await asyncio.to_thread(
+            self.model.predict, pairs, batch_size=settings.RERANKER_BATCH_SIZE, convert_to_numpy=True
+        )
+        ranked = sorted(zip(scores, docs), key=lambda item: item[0], reverse=True)
+        return [d for _, d in ranked[:top_k]]
+
+reranker_service = RerankerService()
@@ -1,8 +1,7 @@
+import asyncio
 import logging
-import tempfile
-import os
-import shutil
 import json
+from typing import List
 from fastapi import UploadFile
 from llama_cloud_services import LlamaParse
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -14,6 +13,50 @@ from app.schemas.extraction import ExtractionField
 
 logger = logging.getLogger(__name__)
 
+# 單一表單分析 Prompt
+ANALYZE_PROMPT = ChatPromptTemplate.from_template("""
+你是一個專業的資料輸入自動化專家。
+請分析以下的【表單內容】，找出所有需要使用者填寫的欄位。
+
+對於每個欄位，請輸出：
+1. "key": 英文變數名稱 (例如 applicant_name, total_revenue)
+2. "description": 這個欄位在問什麼？請轉換成一個明確的問句，方便我去搜尋答案。(例如：請找出申請人的姓名是什麼？)
+3. "data_type": string, number, boolean, or date
+
+【表單內容】:
+{form_content}
+
+請直接輸出 JSON Object，格式如下：
+{{
+    "fields": [
+        {{"key": "...", "description": "...", "data_type": "..."}},
+        ...
+    ]
+}}
+""")
+
+# 多份表單一次分析: 每份表單一個編號區段，一次 LLM 呼叫回傳所有表單的欄位
+BATCH_ANALYZE_PROMPT = ChatPromptTemplate.from_template("""
+你是一個專業的資料輸入自動化專家。
+以下有 {form_count} 份【表單內容】，以 "=== FORM n ===" 分隔。
+請分別分析每一份表單，找出所有需要使用者填寫的欄位。
+
+對於每個欄位，請輸出：
+1. "key": 英文變數名稱 (例如 applicant_name, total_revenue)
+2. "description": 這個欄位在問什麼？請轉換成一個明確的問句，方便我去搜尋答案。(例如：請找出申請人的姓名是什麼？)
+3. "data_type": string, number, boolean, or date
+
+{forms}
+
+請直接輸出 JSON Object，"forms" 陣列的順序必須與表單編號一致，格式如下：
+{{
+    "forms": [
+        {{"fields": [{{"key": "...", "description": "...", "data_type": "..."}}, ...]}},
+        ...
+    ]
+}}
+""")
+
 class SchemaService:
     def __init__(self):
         self.llm = ChatGoogleGenerativeAI(
@@ -22,6 +65,11 @@ class SchemaService:
             temperature=0, # 分析欄位要精準，不要創意
             response_mime_type="application/json"
         )
+        # LlamaParse 解析器 (所有表單共用同一個實例)
+        self.parser = LlamaParse(api_key=settings.LLAMA_CLOUD_API_KEY, result_type="markdown")
+        # Chain 只組合一次，每次分析直接重用
+        self.chain = ANALYZE_PROMPT | self.llm | JsonOutputParser()
+        self.batch_chain = BATCH_ANALYZE_PROMPT | self.llm | JsonOutputParser()
 
     async def analyze_form(self, file: UploadFile) -> list[dict]:
         """
@@ -29,52 +77,49 @@ class SchemaService:
         2. 使用 LLM 識別所有需要填寫的欄位
         3. 回傳欄位定義列表 (JSON)
         """
-        temp_file_path = None
         try:
-            # 1. 儲存暫存檔
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-                shutil.copyfileobj(file.file, tmp)
-                temp_file_path = tmp.name
-
-            # 2. LlamaParse 解析 (它對表格結構理解力最強)
-            parser = LlamaParse(api_key=settings.LLAMA_CLOUD_API_KEY, result_type="markdown")
-            documents = parser.load_data(temp_file_path)
-            form_content = "\n".join([doc.text for doc in documents])
+            # 1 + 2. 讀取上傳內容並以 LlamaParse 非同步解析 (它對表格結構理解力最強)
+            form_content = await self._parse_form(file)
             
             # 3. LLM 分析 (Prompt Engineering)
-            prompt = ChatPromptTemplate.from_template("""
-            你是一個專業的資料輸入自動化專家。
-            請分析以下的【表單內容】，找出所有需要使用者填寫的欄位。
-            
-            對於每個欄位，請輸出：
-            1. "key": 英文變數名稱 (例如 applicant_name, total_revenue)
-            2. "description": 這個欄位在問什麼？請轉換成一個明確的問句，方便我去搜尋答案。(例如：請找出申請人的姓名是什麼？)
-            3. "data_type": string, number, boolean, or date
-
-            【表單內容】:
-            {form_content}
-
-            請直接輸出 JSON Object，格式如下：
-            {{
-                "fields": [
-                    {{"key": "...", "description": "...", "data_type": "..."}},
-                    ...
-                ]
-            }}
-            """)
-            
-            chain = prompt | self.llm | JsonOutputParser()
-            
             logger.info("Analyzing form structure with LLM...")
-            result = await chain.ainvoke({"form_content": form_content})
+            result = await self.chain.ainvoke({"form_content": form_content})
             
             return result.get("fields", [])
 
         except Exception as e:
             logger.error(f"Error analyzing form: {e}")
             raise e
-        finally:
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+
+    async def analyze_forms_batch(self, files: List[UploadFile]) -> List[list[dict]]:
+        """
+        多份表單一次分析: 所有檔案併行解析，再合併成一個 Prompt 只呼叫 LLM 一次
+        回傳順序與 files 一致，每個元素為該表單的欄位定義列表
+        """
+        form_contents = await asyncio.gather(*[self._parse_form(file) for file in files])
+        forms = "\n\n".join(
+            f"=== FORM {i} ({file.filename}) ===\n{content}"
+            for i, (file, content) in enumerate(zip(files, form_contents), start=1)
+        )
+
+        logger.info(f"Analyzing {len(files)} form structures with one LLM call...")
+        result = await self.batch_chain.ainvoke({"form_count": len(files), "forms": forms})
+        analyzed = result.get("forms") if isinstance(result, dict) else None
+        if not isinstance(analyzed, list):
+            analyzed = []
+        # LLM 少回傳或格式錯誤 (非 dict / fields 非列表) 的表單以空列表補齊，確保與 files 一一對應
+        forms_fields = []
+        for i in range(len(files)):
+            entry = analyzed[i] if i < len(analyzed) else None
+            fields = entry.get("fields") if isinstance(entry, dict) else None
+            forms_fields.append(fields if isinstance(fields, list) else [])
+        return forms_fields
+
+    async def _parse_form(self, file: UploadFile) -> str:
+        """以 LlamaParse 非同步解析單一表單，回傳 Markdown 文字 (不阻塞 event loop)"""
+        # LlamaParse 可接受 bytes，省去寫入 / 讀回暫存檔
+        file_bytes = await file.read()
+        job_result = await self.parser.aparse(file_bytes, extra_info={"file_name": file.filename})
+        return "\n".join(page.text for page in job_result.pages)
 
 schema_service = SchemaService()
\ No newline at end of file
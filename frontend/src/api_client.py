@@ -1,10 +1,21 @@
-import requests
+import httpx
+import asyncio
 import os
-import json
+import orjson
 
-# 後端網址 
+# 後端網址
 BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000/api")
 
+# LLM / LlamaParse 處理較久，讀取逾時放寬；連線逾時維持短
+_TIMEOUT = httpx.Timeout(300.0, connect=10.0)
+_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+
+# 全域共用的連線池 (keep-alive)，不必每次呼叫都重新建立 TCP 連線
+_session = httpx.Client(base_url=BACKEND_URL, timeout=_TIMEOUT, limits=_LIMITS)
+
+# JSON 以 orjson 序列化 / 解析 (比標準 json 快數倍，直接產生 bytes)
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
 class APIClient:
     @staticmethod
     def upload_reference(file_objs, session_id):
@@ -17,62 +28,107 @@ class APIClient:
                 ("files", (file.name, file, "application/pdf")) for file in file_objs
             ]
             data_payload = {"session_id": session_id}
-            response = requests.post(f"{BACKEND_URL}/upload-reference", files=files_payload, data=data_payload)
-            response.raise_for_status() 
+            response = _session.post("/upload-reference", files=files_payload, data=data_payload)
+            response.raise_for_status()
             return response.json()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             return {"error": str(e)}
 
     @staticmethod
-    def query_knowledge(question: str, session_id: str):
+    def upload_reference_parallel(file_objs, session_id):
         """
-        呼叫後端進行 RAG 問答
+        多檔上傳 (每個檔案一個請求併行送出)
+        後端多個 worker 可以同時解析不同檔案，回傳格式與 upload_reference 相同
         """
+        async def _upload_all():
+            async with httpx.AsyncClient(base_url=BACKEND_URL, timeout=_TIMEOUT, limits=_LIMITS) as client:
+                async def _one(file):
+                    response = await client.post(
+                        "/upload-reference",
+                        files=[("files", (file.name, file, "application/pdf"))],
+                        data={"session_id": session_id},
+                    )
+                    response.raise_for_status()
+                    return response.json()
+
+                return await asyncio.gather(*[_one(file) for file in file_objs])
+
         try:
-            payload = {"question": question, "session_id": session_id}
-            response = requests.post(f"{BACKEND_URL}/query", json=payload)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            results = asyncio.run(_upload_all())
+            details = [d for r in results for d in r.get("details", [])]
+            return {"uploaded_count": len(details), "details": details}
+        except httpx.HTTPError as e:
             return {"error": str(e)}
-        
+
     @staticmethod
-    def extract_data(fields: list, session_id: str):
+    def embed_query(text: str):
         """
-        呼叫後端 Auto-Fill API
-        fields: List[Dict], e.g., [{"key": "name", "description": "...", "data_type": "string"}]
+        取得問題的向量 (後端 Embedding 有快取)，供語意快取使用
         """
         try:
-            payload = {
-                "session_id": session_id,
-                "fields": fields
-            }
-            
-            response = requests.post(f"{BACKEND_URL}/extract", json=payload)
+            response = _session.post("/embed", content=orjson.dumps({"text": text}), headers=_JSON_HEADERS)
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return orjson.loads(response.content)
+        except httpx.HTTPError as e:
             return {"error": str(e)}
-        
+
+    @staticmethod
+    def stream_knowledge(question: str, session_id: str):
+        """
+        呼叫後端 SSE 問答接口，逐一 yield 事件 (dict)：
+          {"type": "sources" | "done", "source_documents": [...]}
+          {"type": "token", "content": "..."}
+          {"type": "reset"}  (先前的 token 作廢，Agent 改為呼叫工具)
+          {"type": "error", "content": "..."}
+        """
+        try:
+            payload = {"question": question, "session_id": session_id}
+            with _session.stream("POST", "/query-stream", content=orjson.dumps(payload), headers=_JSON_HEADERS) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    # SSE 每個事件為一行 "data: {json}"，事件之間以空行分隔
+                    if line.startswith("data: "):
+                        yield orjson.loads(line[6:])
+        except httpx.HTTPError as e:
+            yield {"type": "error", "content": str(e)}
+
     @staticmethod
-    def analyze_form(file_obj):
+    def extract_data_stream(fields: list, session_id: str):
+        """
+        呼叫後端 Auto-Fill NDJSON 接口，每完成一個欄位就 yield 一個事件 (dict)：
+          {"type": "field", "result": {...}}
+          {"type": "done"} / {"type": "error", "content": "..."}
+        """
         try:
-            files = {"file": (file_obj.name, file_obj, "application/pdf")} # 或 word
-            response = requests.post(f"{BACKEND_URL}/analyze-form", files=files)
+            payload = {"session_id": session_id, "fields": fields}
+            with _session.stream("POST", "/extract-stream", content=orjson.dumps(payload), headers=_JSON_HEADERS) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    # NDJSON: 每行一個完整的 JSON 物件
+                    if line:
+                        yield orjson.loads(line)
+        except httpx.HTTPError as e:
+            yield {"type": "error", "content": str(e)}
+
+    @staticmethod
+    def analyze_form(file_name, file_bytes):
+        try:
+            files = {"file": (file_name, file_bytes, "application/pdf")} # 或 word
+            response = _session.post("/analyze-form", files=files)
             response.raise_for_status()
             return response.json()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             return {"error": str(e)}
-        
+
     @staticmethod
-    def generate_filled_file(file_obj, results_list):
+    def generate_filled_file(file_name, file_bytes, content_type, results_list):
         try:
-            # 準備 multipart/form-data
-            files = {"file": (file_obj.name, file_obj, file_obj.type)}
-            data = {"results_json": json.dumps(results_list)}
-            
-            response = requests.post(f"{BACKEND_URL}/generate-file", files=files, data=data)
-            
+            # 準備 multipart/form-data (直接送出檔案內容 bytes)
+            files = {"file": (file_name, file_bytes, content_type or "application/octet-stream")}
+            data = {"results_json": orjson.dumps(results_list).decode()}
+
+            response = _session.post("/generate-file", files=files, data=data)
+
             if response.status_code == 200:
                 return response.content # 回傳二進制檔案內容
             else:
@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+from itertools import count
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+class SemanticCache:
+    """
+    語意問答快取: 問題向量與近期問題的 cosine 相似度 >= threshold 時直接沿用舊答案
+    以 Random-Projection LSH 找候選 (每張表把向量投影到 bits 個隨機超平面得到簽章)，
+    候選再以精確 cosine 驗證；每個 Session 各自一份，最多保留 max_entries 筆
+    Session 數也有上限 (max_sessions)，超過時淘汰最久沒使用的 Session (關掉的分頁不會一直佔用記憶體)
+    """
+
+    def __init__(
+        self,
+        bits: int = 12,
+        tables: int = 8,
+        threshold: float = 0.95,
+        max_entries: int = 256,
+        max_sessions: int = 64,
+        seed: int = 42,
+    ):
+        self.bits = bits
+        self.tables = tables
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_sessions = max_sessions
+        self._rng = np.random.default_rng(seed)
+        self._planes: Optional[np.ndarray] = None # shape: (tables, bits, dim)，第一次看到向量時才決定維度
+        self._weights = 1 << np.arange(bits)
+        self._ids = count()
+        # session_id -> {"entries": OrderedDict[id, (vector, payload, signatures)], "buckets": [dict(signature -> [id])]}
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict() # 依最近使用排序
+        self._lock = threading.Lock()
+
+    def _signatures(self, vector: np.ndarray) -> List[int]:
+        if self._planes is None or self._planes.shape[2] != vector.shape[0]:
+            # 向量維度改變 (換了 Embedding 模型)，舊簽章全部失效
+            self._planes = self._rng.standard_normal((self.tables, self.bits, vector.shape[0]))
+            self._sessions.clear()
+        bits = (self._planes @ vector) > 0
+        return (bits @ self._weights).tolist()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def get(self, session_id: str, vector) -> Optional[Tuple[str, list]]:
+        """回傳 (answer, source_documents)，沒有夠相近的問題時回傳 None"""
+        v = self._normalize(vector)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if not session:
+                return None
+            self._sessions.move_to_end(session_id)
+            candidates = set()
+            for bucket, signature in zip(session["buckets"], self._signatures(v)):
+                candidates.update(bucket.get(signature, ()))
+            if not candidates:
+                return None
+
+            ids = list(candidates)
+            entries = session["entries"]
+            sims = np.stack([entries[i][0] for i in ids]) @ v
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            return entries[ids[best]][1]
+
+    def put(self, session_id: str, vector, answer: str, sources: list):
+        v = self._normalize(vector)
+        with self._lock:
+            signatures = self._signatures(v)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = {"entries": OrderedDict(), "buckets": [{} for _ in range(self.tables)]}
+                # Session 數超過上限時整份淘汰最久沒使用的
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            entry_id = next(self._ids)
+            session["entries"][entry_id] = (v, (answer, list(sources)), signatures)
+            for bucket, signature in zip(session["buckets"], signatures):
+                bucket.setdefault(signature, []).append(entry_id)
+
+            # 超過上限時淘汰最舊的問題
+            if len(session["entries"]) > self.max_entries:
+                old_id, (_, _, old_signatures) = session["entries"].popitem(last=False)
+                for bucket, signature in zip(session["buckets"], old_signatures):
+                    bucket[signature].remove(old_id)
+                    if not bucket[signature]:
+                        del bucket[signature]
+
+    def clear(self, session_id: str):
+        """該 Session 的知識庫有變動時，舊答案全部作廢"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
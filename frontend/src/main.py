@@ -1,7 +1,33 @@
 import streamlit as st
 import pandas as pd
+import hashlib
+import html
+import orjson
+import re
+import time
 import uuid
-from api_client import api_client
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from markdown_it import MarkdownIt
+from api_client import APIClient
+from chat_cache import SemanticCache
+
+# 聊天室每次 rerun 最多渲染的歷史訊息數
+CHAT_WINDOW = 30
+# 欄位答案快取的有效時間 (秒)
+FIELD_CACHE_TTL = 600
+# 按下 Generate 時等待背景預先產生檔案的上限 (秒)，逾時改為直接重新產生
+PREFETCH_TIMEOUT = 30
+_WHITESPACE_RE = re.compile(r"\s+")
+# 串流回答時畫面更新的最短間隔 (秒)；遇到句尾則立即更新
+STREAM_FLUSH_INTERVAL = 0.05
+_SENTENCE_ENDINGS = (".", "!", "?", "。", "！", "？", "\n")
+# 回答下方的來源小字 (Markdown 轉換後才接上的 HTML，來源名稱會先經過 html.escape)
+_REF_TMPL = "<p><small style='color:grey'>Ref: {refs}</small></p>"
+_GEN_TMPL = "<p><small style='color:grey'>(General Knowledge)</small></p>"
+# 預設範例欄位 (tuple 不可變，可以直接當作 schema records 使用而不必複製)
+_DEFAULT_SCHEMA: tuple[dict, ...] = (
+    {"key": "example_field", "description": "Example description...", "data_type": "string"},
+)
 
 # 頁面全域設定 
 st.set_page_config(
@@ -10,8 +36,8 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# CSS 
-st.markdown("""
+# CSS
+_PAGE_CSS = """
 <style>
     /* 調整標題間距 */
     .block-container {
@@ -27,7 +53,168 @@ st.markdown("""
         font-weight: bold;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_resource
+def get_markdown_renderer() -> MarkdownIt:
+    # 聊天訊息唯一的 Markdown -> HTML 轉換器 (GFM: 表格 / 刪除線 / 自動連結)
+    # html=False: 訊息中的原始 HTML 一律 escape，模型或使用者輸入的標籤不會被當成 HTML
+    return MarkdownIt("gfm-like", {"html": False})
+
+def _render_message(text: str) -> str:
+    # 訊息加入歷史時只轉換一次，之後 rerun 以 st.html 直接輸出 HTML，不會再被當成 Markdown 解析
+    return get_markdown_renderer().render(text)
+
+@st.cache_resource
+def get_api_client() -> APIClient:
+    # API Client 與其連線池跨 rerun 重用
+    return APIClient()
+
+@st.cache_resource
+def get_semantic_cache() -> SemanticCache:
+    # 所有使用者共用一個快取物件 (內部依 session_id 分開存放)
+    return SemanticCache(threshold=0.95)
+
+@st.cache_resource
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    # 背景預先產生填好的檔案 (跨 rerun 共用同一個 thread pool)
+    return ThreadPoolExecutor(max_workers=2)
+
+def _fill_fingerprint(form_bytes: bytes, results: list) -> str:
+    # 表單內容 + 抽取結果的指紋，任一變動時預先產生的檔案就不能沿用
+    digest = hashlib.blake2b(form_bytes, digest_size=16)
+    digest.update(orjson.dumps(results))
+    return digest.hexdigest()
+
+def _prefetch_filled_file():
+    # 抽取完成後立刻在背景產生填好的檔案，使用者按下 Generate 時通常已經完成
+    form_bytes = st.session_state.get("target_form_bytes")
+    results = st.session_state.get("extraction_results")
+    if not form_bytes or not results:
+        return
+    st.session_state.prefetched_file = (
+        _fill_fingerprint(form_bytes, results),
+        get_prefetch_executor().submit(
+            api_client.generate_filled_file,
+            st.session_state.get("target_form_name"),
+            form_bytes,
+            st.session_state.get("target_form_type"),
+            results,
+        ),
+    )
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _analyze_form_cached(file_hash: str, file_name: str, _file_bytes: bytes) -> dict:
+    # 以檔案內容 hash 為 key (底線開頭的參數不參與 Streamlit 的快取 hash)，同一份表格再按一次分析直接回傳
+    res = api_client.analyze_form(file_name, _file_bytes)
+    if "error" in res:
+        # 拋出例外的結果不會被快取，下次可以重試
+        raise RuntimeError(res["error"])
+    return res
+
+def _set_schema(records):
+    # schema_df 給 data_editor 顯示；schema_records 是同一份資料的 records 形式 (執行抽取時直接送出)
+    # records 只會被整個替換、不會就地修改，所以不必複製
+    st.session_state.schema_df = pd.DataFrame(list(records))
+    st.session_state.schema_base_records = records
+    st.session_state.schema_records = records
+
+def _sync_schema_records():
+    # data_editor 的變更差量 (相對於 schema_df) 直接套用到 records，不必每次把 DataFrame 轉回 dict
+    delta = st.session_state.schema_editor
+    records = [dict(r) for r in st.session_state.schema_base_records]
+    for row, changes in delta.get("edited_rows", {}).items():
+        records[int(row)].update(changes)
+    deleted = set(delta.get("deleted_rows", []))
+    records = [r for i, r in enumerate(records) if i not in deleted]
+    records.extend(dict(r) for r in delta.get("added_rows", []))
+    st.session_state.schema_records = records
+
+def _field_cache_key(field: dict, doc_hash):
+    # 描述正規化 (小寫、合併空白) 後，相同問題 + 相同知識庫就共用答案
+    description = _WHITESPACE_RE.sub(" ", str(field.get("description", "")).lower().strip())
+    return (description, field.get("data_type", "string"), doc_hash)
+
+@st.fragment
+def _results_panel():
+    # Fragment: 只有這個區塊內的互動會觸發局部 rerun，其他元件的變動不必重繪結果表格
+    st.subheader("2. Extraction Results")
+
+    results = st.session_state.extraction_results
+
+    if results:
+        # 直接把 records 交給 st.dataframe，只顯示指定欄位 (不必每次 rerun 都建 DataFrame)
+        st.dataframe(
+            results,
+            column_order=("key", "value", "confidence", "source"),
+            width='stretch',
+            column_config={
+                "key": "Field",
+                "value": "Extracted Value",
+                "confidence": "Confidence",
+                "source": "Source Doc"
+            }
+        )
+
+        # 提供 JSON 下載
+        st.download_button(
+            label="Download JSON",
+            data=orjson.dumps(results, option=orjson.OPT_INDENT_2), # orjson 直接輸出 UTF-8 bytes
+            file_name="extracted_data.json",
+            mime="application/json"
+        )
+    else:
+        st.info("No results yet. Define schema and click Run.")
+
+@st.fragment
+def _download_panel():
+    # 按下 Generate 只重跑這個區塊，不必重繪上方的 Schema 編輯器
+    st.subheader("3. Download Filled Document")
+
+    # 取得當前上傳的 Target Form (上傳時已把內容存進 session_state)
+    target_form_bytes = st.session_state.get("target_form_bytes")
+    target_form_name = st.session_state.get("target_form_name")
+
+    if st.button("Generate Filled File"):
+        if target_form_bytes:
+            with st.spinner("Generating document..."):
+                # 背景已預先產生且表單 / 結果都沒變時直接取用，否則重新產生
+                prefetched = st.session_state.get("prefetched_file")
+                fingerprint = _fill_fingerprint(target_form_bytes, st.session_state.extraction_results or [])
+                file_content = None
+                if prefetched and prefetched[0] == fingerprint:
+                    try:
+                        file_content = prefetched[1].result(timeout=PREFETCH_TIMEOUT)
+                    except FutureTimeoutError:
+                        file_content = None
+                    if file_content is None or (isinstance(file_content, dict) and "error" in file_content):
+                        # 背景產生失敗或逾時: 丟掉這個結果，避免之後一直重用失敗的 future
+                        st.session_state.pop("prefetched_file", None)
+                        file_content = None
+                if file_content is None:
+                    file_content = api_client.generate_filled_file(
+                        target_form_name,
+                        target_form_bytes,
+                        st.session_state.get("target_form_type"),
+                        st.session_state.extraction_results
+                    )
+
+                if isinstance(file_content, dict) and "error" in file_content:
+                    st.error(file_content["error"])
+                else:
+                    # 提供下載按鈕
+                    st.download_button(
+                        label="Click to Download",
+                        data=file_content,
+                        file_name=f"filled_{target_form_name}",
+                        mime="application/octet-stream"
+                    )
+        else:
+            st.warning("Target form session expired. Please upload the form again.")
+
+api_client = get_api_client()
+
+st.markdown(_PAGE_CSS, unsafe_allow_html=True)
 
 # === Session ID 管理  ===
 if "session_id" not in st.session_state:
@@ -53,11 +240,14 @@ with st.sidebar:
     st.caption(f"Session: {st.session_state.session_id[-8:]}...")
     
     if st.button("New Chat / Clear Memory", type="secondary"):
-        # 重置所有狀態
+        # 重置所有狀態 (舊 Session 的語意快取一併釋放)
+        get_semantic_cache().clear(st.session_state.session_id)
         st.session_state.session_id = str(uuid.uuid4())
         st.session_state.messages = []
         st.session_state.upload_status = None
         st.session_state.extraction_results = None
+        st.session_state.doc_hash = ""
+        st.session_state.field_cache = {}
         st.rerun() # 重新整理頁面
     
     # === 功能切換 ===
@@ -77,14 +267,25 @@ with st.sidebar:
         if st.button("Process Document(s)", type="primary"):
             with st.status("Processing...", expanded=True) as status:
                 st.write("Uploading to server...")
-                result = api_client.upload_reference(uploaded_files, st.session_state.session_id)
+                if len(uploaded_files) > 1:
+                    # 多檔時每個檔案各自一個請求併行上傳，後端可同時解析
+                    result = api_client.upload_reference_parallel(uploaded_files, st.session_state.session_id)
+                else:
+                    result = api_client.upload_reference(uploaded_files, st.session_state.session_id)
                 
                 if "error" in result:
                     status.update(label="Failed", state="error")
                     st.error(result['error'])
                 else:
+                    # 知識庫內容的指紋 (欄位答案快取以此區分)，檔案有變動時舊答案自然失效
+                    digest = hashlib.blake2b(st.session_state.get("doc_hash", "").encode(), digest_size=16)
+                    for f in uploaded_files:
+                        digest.update(f.getvalue())
+                    st.session_state.doc_hash = digest.hexdigest()
                     count = result.get('uploaded_count', 0)
                     st.write(f"Indexed {count} files successfully!")
+                    # 知識庫變了，舊的語意快取答案作廢
+                    get_semantic_cache().clear(st.session_state.session_id)
                     status.update(label="System Ready", state="complete", expanded=False)
                     st.session_state.upload_status = "ready"
     
@@ -103,16 +304,23 @@ if mode == "Chat Assistant":
     
     chat_container = st.container()
     
-    # 顯示歷史訊息
+    # 顯示歷史訊息 (只渲染最近 CHAT_WINDOW 則，較早的訊息要使用者展開才渲染)
+    # 每則訊息存成 (role, html) tuple，比 dict 省記憶體；html 在加入歷史時已轉換好
     with chat_container:
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"], avatar=None):
-                st.markdown(message["content"])
+        messages = st.session_state.messages
+        earlier = messages[:-CHAT_WINDOW]
+        if earlier and st.toggle(f"Show {len(earlier)} earlier messages", key="show_earlier"):
+            for role, body in earlier:
+                with st.chat_message(role, avatar=None):
+                    st.html(body)
+        for role, body in messages[-CHAT_WINDOW:]:
+            with st.chat_message(role, avatar=None):
+                st.html(body)
 
     # 輸入框
     if prompt := st.chat_input("Ask a question about the document..."):
         # 顯示使用者輸入
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        st.session_state.messages.append(("user", _render_message(prompt)))
         with chat_container:
             with st.chat_message("user", avatar=None):
                 st.markdown(prompt)
@@ -121,29 +329,54 @@ if mode == "Chat Assistant":
         with chat_container:
             with st.chat_message("assistant", avatar=None):
                 message_placeholder = st.empty()
-                message_placeholder.markdown("Thinking...")
-                    
-                response = api_client.query_knowledge(prompt, st.session_state.session_id)
-                if "error" in response:
-                        full_res = f"Error: {response['error']}"
-                else:
-                    ans = response.get("answer", "")
-                    if isinstance(ans, list):
-                        # 列表接成字串
-                        ans = "".join([str(x) if isinstance(x, str) else str(x.get('text','')) for x in ans])
-                    elif not isinstance(ans, str):
-                        ans = str(ans)
-                    src = list(set(response.get("source_documents", [])))
-                    # 根據有沒有來源，顯示不同的小字
-                    if src:
-                        src_text = f"\n\n<small style='color:grey'>Ref: {', '.join(src)}</small>"
+
+                ans = ""
+                src = []
+                error = None
+                with st.spinner("Thinking..."):
+                    # 語意快取: 與近期問題夠相近時直接沿用答案，不必再跑檢索 + LLM
+                    semantic_cache = get_semantic_cache()
+                    embedded = api_client.embed_query(prompt)
+                    query_vector = embedded.get("embedding")
+                    hit = semantic_cache.get(st.session_state.session_id, query_vector) if query_vector else None
+
+                    if hit:
+                        ans, src = hit
                     else:
-                        src_text = f"\n\n<small style='color:grey'>(General Knowledge)</small>"
-                        
-                    full_res = ans + src_text 
+                        # 以 SSE 串流接收回答 (不必等整段回答完成)
+                        # 畫面至少間隔 STREAM_FLUSH_INTERVAL 才更新一次 (句尾立即更新)，減少前端重繪次數
+                        last_flush = time.monotonic()
+                        for event in api_client.stream_knowledge(prompt, st.session_state.session_id):
+                            if event["type"] == "token":
+                                ans += event["content"]
+                                now = time.monotonic()
+                                if now - last_flush >= STREAM_FLUSH_INTERVAL or ans.endswith(_SENTENCE_ENDINGS):
+                                    # 串流中在結尾顯示游標，提示回答仍在產生
+                                    message_placeholder.markdown(ans + "▌")
+                                    last_flush = now
+                            elif event["type"] == "reset":
+                                # Agent 呼叫工具前輸出的文字不是最終回答，清掉重新累積
+                                ans = ""
+                                message_placeholder.empty()
+                            elif event["type"] in ("sources", "done"):
+                                src = event.get("source_documents", [])
+                            elif event["type"] == "error":
+                                error = event["content"]
+                        # 只快取成功且有內容的回答 (暫時性錯誤不應被相近問題重複取用)
+                        if query_vector and not error and ans.strip():
+                            semantic_cache.put(st.session_state.session_id, query_vector, ans, src)
+
+                if error:
+                    rendered = _render_message(f"Error: {error}")
+                else:
+                    # 去重但保留順序 (畫面輸出穩定，不會因 set 順序不同而重繪)
+                    src = list(dict.fromkeys(src)) if src else () # 沒有來源時不必建立任何容器
+                    # 根據有沒有來源，顯示不同的小字 (檔名可能含 HTML 字元，先 escape 再放進 HTML)
+                    src_text = _REF_TMPL.format(refs=", ".join(map(html.escape, src))) if src else _GEN_TMPL
+                    rendered = _render_message(ans) + src_text
 
-                message_placeholder.markdown(full_res, unsafe_allow_html=True)
-                st.session_state.messages.append({"role": "assistant", "content": full_res})
+                message_placeholder.html(rendered)
+                st.session_state.messages.append(("assistant", rendered))
 
 # === 自動填表 ===
 elif mode == "Auto-Fill Extraction":
@@ -159,25 +392,32 @@ elif mode == "Auto-Fill Extraction":
         st.info("Step A: 上傳你要填寫的「空白表格」(PDF/Word)")
         target_form = st.file_uploader("Upload Target Form", type=["pdf", "docx"], key="target_form")
         if target_form:
-            st.session_state["uploaded_target_form_obj"] = target_form # 把物件存起來
+            # 存檔案內容 (bytes) 而非 UploadedFile 物件，rerun 後 uploader 物件消失也能繼續使用
+            st.session_state["target_form_name"] = target_form.name
+            st.session_state["target_form_type"] = target_form.type
+            st.session_state["target_form_bytes"] = target_form.getvalue()
         
         # 初始化 Session 中的欄位資料
         if "schema_df" not in st.session_state:
             # 預設範例
-            st.session_state.schema_df = pd.DataFrame([
-                {"key": "example_field", "description": "Example description...", "data_type": "string"}
-            ])
+            _set_schema(_DEFAULT_SCHEMA)
 
         if target_form:
             if st.button("AI Analyze Form Structure", type="secondary"):
                 with st.spinner("AI is reading the form structure..."):
-                    res = api_client.analyze_form(target_form)
-                    if "error" in res:
-                        st.error(res["error"])
+                    form_bytes = st.session_state["target_form_bytes"]
+                    try:
+                        res = _analyze_form_cached(
+                            hashlib.blake2b(form_bytes, digest_size=16).hexdigest(),
+                            st.session_state["target_form_name"],
+                            form_bytes,
+                        )
+                    except RuntimeError as e:
+                        st.error(str(e))
                     else:
                         fields = res.get("fields", [])
                         if fields:
-                            st.session_state.schema_df = pd.DataFrame(fields)
+                            _set_schema(fields)
                             st.success(f"Detected {len(fields)} fields!")
                         else:
                             st.warning("Could not detect any fields.")
@@ -186,7 +426,7 @@ elif mode == "Auto-Fill Extraction":
         st.markdown("Step B: 確認或修改 AI 抓到的欄位")
         
         # 讓使用者編輯 AI 分析出來的結果
-        edited_df = st.data_editor(
+        st.data_editor(
             st.session_state.schema_df, 
             num_rows="dynamic",
             width='stretch',
@@ -195,89 +435,66 @@ elif mode == "Auto-Fill Extraction":
                 "description": st.column_config.TextColumn("Question for AI", required=True),
             },
             hide_index=True,
-            key="schema_editor" # 加上 key 避免重繪問題
+            key="schema_editor", # 加上 key 避免重繪問題
+            on_change=_sync_schema_records,
         )
 
         st.markdown("---")
         st.markdown("Step C: 執行填寫")
         if st.button("Run Extraction (RAG + Web)", type="primary"):
-             # 直接執行
-            with st.spinner("AI is finding answers (Checking Docs -> Web)..."):
-                fields_payload = edited_df.to_dict(orient="records")
-                # 記得補上 data_type
-                for f in fields_payload:
-                     if "data_type" not in f: f["data_type"] = "string"
-
-                # 呼叫後端 (傳入 session_id)
-                result = api_client.extract_data(fields_payload, st.session_state.session_id)
-                
-                if "error" in result:
-                    st.error(result["error"])
+            # 記得補上 data_type (複製一份，不改動 schema_records)
+            fields_payload = [{"data_type": "string", **f} for f in st.session_state.schema_records]
+            for f in fields_payload:
+                 if not f["data_type"]: f["data_type"] = "string"
+
+            # 先查欄位答案快取 (相同描述 + 相同知識庫，TTL 內直接沿用)，只把未命中的欄位送到後端
+            field_cache = st.session_state.setdefault("field_cache", {})
+            doc_hash = st.session_state.get("doc_hash", "")
+            now = time.monotonic()
+            collected = {}
+            pending_fields = []
+            for f in fields_payload:
+                cached = field_cache.get(_field_cache_key(f, doc_hash))
+                if cached and now - cached[1] < FIELD_CACHE_TTL:
+                    collected[f["key"]] = {**cached[0], "key": f["key"]}
                 else:
-                    st.session_state.extraction_results = result.get("results", [])
-                    st.success("Extraction Complete!")
+                    pending_fields.append(f)
+            pending_by_key = {f["key"]: f for f in pending_fields}
+
+            # 呼叫後端串流接口 (傳入 session_id)，每完成一個欄位就更新進度與表格
+            progress = st.progress(len(collected) / max(len(fields_payload), 1), text="AI is finding answers (Checking Docs -> Web)...")
+            live_table = st.empty()
+            error = None
+            events = api_client.extract_data_stream(pending_fields, st.session_state.session_id) if pending_fields else []
+            for event in events:
+                if event["type"] == "field":
+                    item = event["result"]
+                    collected[item["key"]] = item
+                    if item["key"] in pending_by_key and item.get("value") != "N/A":
+                        field_cache[_field_cache_key(pending_by_key[item["key"]], doc_hash)] = (item, time.monotonic())
+                    progress.progress(
+                        len(collected) / len(fields_payload),
+                        text=f"Extracted {len(collected)}/{len(fields_payload)} fields",
+                    )
+                    live_table.dataframe(list(collected.values()), width='stretch')
+                elif event["type"] == "error":
+                    error = event["content"]
+
+            progress.empty()
+            live_table.empty()
+            if error:
+                st.error(error)
+            else:
+                # 依欄位原本的順序排列
+                st.session_state.extraction_results = [
+                    collected[f["key"]] for f in fields_payload if f["key"] in collected
+                ]
+                st.success("Extraction Complete!")
+                _prefetch_filled_file()
     
     # 右側：顯示結果
     with col2:
-        st.subheader("2. Extraction Results")
-        
-        results = st.session_state.extraction_results
-        
-        if results:
-            res_df = pd.DataFrame(results)
-            display_df = res_df[["key", "value", "confidence", "source"]]
-            
-            st.dataframe(
-                display_df, 
-                width='stretch',
-                column_config={
-                    "key": "Field",
-                    "value": "Extracted Value",
-                    "confidence": "Confidence",
-                    "source": "Source Doc"
-                }
-            )
-            
-            # 提供 JSON 下載
-            st.download_button(
-                label="Download JSON",
-                data=res_df.to_json(orient="records", indent=2, force_ascii=False),
-                file_name="extracted_data.json",
-                mime="application/json"
-            )
-        else:
-            st.info("No results yet. Define schema and click Run.")
+        _results_panel()
     
     st.markdown("---")
-    st.subheader("3. Download Filled Document")
-    
-    # 取得當前上傳的 Target Form
-    target_form = st.session_state.get("uploaded_target_form_obj") # 這裡你要在上面 upload 時存起來
-    
-    # *注意*: Streamlit 的 file_uploader 物件如果頁面重整會消失
-    # 為了簡化，我們這裡假設使用者還沒重新整理
-    
-    if st.button("Generate Filled File"):
-        # 這裡需要一個小技巧：因為 target_form 是一個 Streamlit UploadedFile 物件
-        # 我們需要確保它是可讀的
-        if target_form:
-            target_form.seek(0) # 重置游標
-            
-            with st.spinner("Generating document..."):
-                file_content = api_client.generate_filled_file(
-                    target_form, 
-                    st.session_state.extraction_results
-                )
-                
-                if isinstance(file_content, dict) and "error" in file_content:
-                    st.error(file_content["error"])
-                else:
-                    # 提供下載按鈕
-                    st.download_button(
-                        label="Click to Download",
-                        data=file_content,
-                        file_name=f"filled_{target_form.name}",
-                        mime="application/octet-stream"
-                    )
-        else:
-            st.warning("Target form session expired. Please upload the form again.")
+    _download_panel()